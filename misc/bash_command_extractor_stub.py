@@ -0,0 +1,100 @@
+"""
+Local stand-in for bash-command-extractor API (to run and benchmark log parsing offline)
+
+Commands are naively split on shell separators, the response has the same shape as the Node service:
+{"commands": [{"command": ..., "args": [...], "annotations": [], "categories": []}], "errors": null}
+
+Usage: python misc/bash_command_extractor_stub.py --port 8080 --latency 0.05
+Then: BASH_PARSER_API_URL=http://127.0.0.1:8080 python src/worker.py
+"""
+
+import argparse
+import json
+import logging
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+    datefmt="%Y-%m-%dT%H:%M:%S%z",
+    level=logging.INFO,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SHELL_SEPARATORS = re.compile(r"&&|\|\||;|\||&|\n")
+
+
+def extract_commands(code: str):
+    """
+    Naive extraction of commands: split on shell separators, then on whitespaces
+    """
+    commands = []
+    for command_line in SHELL_SEPARATORS.split(code):
+        words = command_line.split()
+        if not words:
+            continue
+        commands.append(
+            {
+                "annotations": [],
+                "command": words[0],
+                "categories": [],
+                "args": [{"annotations": [], "content": word} for word in words[1:]],
+            }
+        )
+    return commands
+
+
+class BashCommandExtractorHandler(BaseHTTPRequestHandler):
+    """
+    Answer POST requests with text/plain shell code as body
+    """
+
+    latency: float = 0
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Extract commands from shell code
+        """
+        code = self.rfile.read(int(self.headers.get("Content-Length", "0"))).decode("utf-8")
+        time.sleep(self.latency)  # Simulate the processing time of the Node service
+
+        if not code:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(b"Empty body")
+            return
+
+        body = json.dumps({"commands": extract_commands(code), "errors": None}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug(format, *args)
+
+
+def main():
+    """
+    Entrypoint function
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="Delay (in seconds) added to each response")
+    args = parser.parse_args()
+
+    BashCommandExtractorHandler.latency = args.latency
+    server = ThreadingHTTPServer((args.host, args.port), BashCommandExtractorHandler)
+    LOGGER.info("Listening on http://%s:%d (latency: %0.3fs)", args.host, args.port, args.latency)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
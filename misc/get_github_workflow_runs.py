@@ -9,10 +9,10 @@ import os
 from datetime import datetime, timedelta
 
 import pymongo
-from pymongo.errors import DuplicateKeyError
 from tqdm import tqdm
 
 from src.api.github import GithubApi
+from src.tools.mongo import DUPLICATE_KEY_ERROR, BulkWriter
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(filename)s %(funcName)s %(message)s",
@@ -81,13 +81,22 @@ def process_repo(repo):
             )
             return
 
-    for workflow_name, runs in workflow_runs.items():
-        LOGGER.info("Processing workflow '%s' (%d runs)", workflow_name, len(runs))
+    failed_runs = []  # Runs not inserted (other errors than duplicate keys)
 
-        for run in runs:
-            run_uid = f"{repo['name']}_{workflow_name}_{run['run_number']}_{run['run_attempt']}"
-            try:
-                MONGO_RUNS.insert_one(
+    def on_insert_error(write_error):
+        if write_error["code"] == DUPLICATE_KEY_ERROR:
+            LOGGER.warning("%s already scraped", write_error["op"]["_id"])
+        else:
+            LOGGER.error("Fail to insert %s: %s", write_error["op"]["_id"], write_error["errmsg"])
+            failed_runs.append(write_error["op"]["_id"])
+
+    with BulkWriter(MONGO_RUNS) as runs_writer:
+        for workflow_name, runs in workflow_runs.items():
+            LOGGER.info("Processing workflow '%s' (%d runs)", workflow_name, len(runs))
+
+            for run in runs:
+                run_uid = f"{repo['name']}_{workflow_name}_{run['run_number']}_{run['run_attempt']}"
+                runs_writer.insert_one(
                     {
                         "_id": run_uid,
                         "repository_name": repo["name"],
@@ -95,10 +104,14 @@ def process_repo(repo):
                         "run_number": run["run_number"],
                         "run_attempt": run["run_attempt"],
                         "metadata": run,
-                    }
+                    },
+                    on_error=on_insert_error,
                 )
-            except DuplicateKeyError:
-                LOGGER.warning("%s already scraped", run_uid)
+
+    # Repository is not marked as scraped if runs are missing: it is processed again on next execution
+    if failed_runs:
+        LOGGER.error("%d runs of %s not inserted: repository will be processed again", len(failed_runs), repo["name"])
+        return
 
     # Insert repo only after processing runs
     MONGO_REPOSITORIES.insert_one({"_id": repo["name"], "total_runs_90d": len(all_runs), "repo": repo})
@@ -0,0 +1,102 @@
+"""
+Storage report of dedup log archives (LOGS_ARCHIVE_FORMAT=dedup), and maintenance of their chunk store
+
+Usage:
+- python -m misc.logs_store_report: sizes and dedup ratio
+- python -m misc.logs_store_report --gc: also remove objects not referenced by any archive (e.g., of deleted runs)
+- python -m misc.logs_store_report --export data/logs/<repo>/<workflow>/<run>.dedup run.tar.gz: rebuild a run archive
+"""
+
+import argparse
+import logging
+import os
+
+from tqdm import tqdm
+
+from src.logs.archive import ChunkStore, DedupArchiveReader, convert_archive
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)s %(filename)s %(funcName)s %(message)s",
+    level=logging.DEBUG if os.environ.get("DEBUG") == "true" else logging.INFO,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+LOGS_DIR = os.path.join(os.environ.get("DATA_DIR", "data"), "logs")
+
+
+def find_archives(logs_dir: str):
+    """
+    Paths of dedup archives
+    """
+    for directory, _, files in os.walk(logs_dir):
+        for file in files:
+            if file.endswith(".dedup"):
+                yield os.path.join(directory, file)
+
+
+def report(store: ChunkStore, collect_garbage: bool = False) -> None:
+    """
+    Log sizes of logs and of the chunk store, remove unreferenced objects if collect_garbage
+    """
+    runs, members, logs_size, manifests_size = 0, 0, 0, 0
+    chunks_size, timestamps_size = 0, 0
+    objects: dict = {}  # Size (uncompressed) by digest of referenced objects
+    for path in tqdm(list(find_archives(LOGS_DIR))):
+        runs += 1
+        manifests_size += os.path.getsize(path)
+        with DedupArchiveReader(path, store=store) as archive_fd:
+            for member in archive_fd.getmembers():
+                members += 1
+                logs_size += member.size
+                for digest, size in member.chunks:
+                    chunks_size += size
+                    objects[digest] = size
+                for digest, size in member.timestamps:
+                    timestamps_size += size
+                    objects[digest] = size
+
+    unique_size = sum(objects.values())
+    stored_size = sum(os.path.getsize(store.path(digest)) for digest in objects) + manifests_size
+    LOGGER.info("%d runs, %d members: %0.2fMB of logs", runs, members, logs_size / 10**6)
+    LOGGER.info(
+        "Content without timestamps: %0.2fMB, timestamps: %0.2fMB",
+        chunks_size / 10**6,
+        timestamps_size / 10**6,
+    )
+    LOGGER.info(
+        "%d unique objects: %0.2fMB (dedup ratio: %0.2f)",
+        len(objects),
+        unique_size / 10**6,
+        (chunks_size + timestamps_size) / unique_size if unique_size else 1,
+    )
+    LOGGER.info(
+        "Stored (compressed objects and manifests): %0.2fMB (ratio to logs: %0.2f)",
+        stored_size / 10**6,
+        logs_size / stored_size if stored_size else 1,
+    )
+
+    if collect_garbage:
+        removed_objects, removed_size = store.collect_garbage(set(objects))
+        LOGGER.info("%d unreferenced objects removed (%0.2fMB)", removed_objects, removed_size / 10**6)
+
+
+def main():
+    """
+    Entrypoint function
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gc", action="store_true", help="Remove objects not referenced by any archive")
+    parser.add_argument("--export", nargs=2, metavar=("ARCHIVE", "OUTPUT"), help="Rebuild an archive (e.g., as tar.gz)")
+    args = parser.parse_args()
+
+    if args.export:
+        convert_archive(*args.export)
+        LOGGER.info("%s written", args.export[1])
+        return
+
+    report(ChunkStore(), collect_garbage=args.gc)
+
+
+if __name__ == "__main__":
+    main()
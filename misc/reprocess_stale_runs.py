@@ -0,0 +1,142 @@
+"""
+Reprocess runs parsed with other versions of the log parser or of bash-command-extractor (see PARSING_VERSIONS)
+Only repositories with stale runs are requeued, and the worker only parses stale runs of these repositories
+
+Usage:
+- python -m misc.reprocess_stale_runs: enqueue repositories with stale runs
+- python -m misc.reprocess_stale_runs --status: progress of the reprocessing
+- python -m misc.reprocess_stale_runs --all: enqueue all repositories (e.g., to apply a new retention policy)
+"""
+
+import argparse
+import logging
+import os
+import random
+from datetime import datetime
+
+import pymongo
+from tqdm import tqdm
+
+from src.logs.parser import PARSING_VERSIONS
+from src.tools.mq import PikaWrapper
+
+# Setup logging
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+    datefmt="%Y-%m-%dT%H:%M:%S%z",
+)
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG if os.environ.get("DEBUG", "false") == "true" else logging.INFO)
+
+MONGO_CLIENT = pymongo.MongoClient(
+    host=os.environ.get("MONGODB_HOST", "127.0.0.1"),
+    port=int(os.environ.get("MONGODB_PORT", "27017")),
+)
+MONGO_REPOSITORIES = MONGO_CLIENT["gha-scraper"]["repositories"]
+MONGO_RUNS         = MONGO_CLIENT["gha-scraper"]["runs"]
+
+# Runs with a log archive that were not parsed with the current versions
+STALE_RUNS_FILTER = {
+    "logs_archive.path": {"$exists": True},
+    "$or": [{f"parsing_versions.{key}": {"$ne": version}} for key, version in PARSING_VERSIONS.items()],
+}
+
+
+def count_stale_runs():
+    """
+    Number of stale runs by repository
+    """
+    return {
+        result["_id"]: result["stale_runs"]
+        for result in MONGO_RUNS.aggregate(
+            [
+                {"$match": STALE_RUNS_FILTER},
+                {"$group": {"_id": "$repository_name", "stale_runs": {"$sum": 1}}},
+            ]
+        )
+    }
+
+
+def print_status():
+    """
+    Progress of the reprocessing planned for the current versions
+    """
+    planned_filter = {"reprocess.parsing_versions": PARSING_VERSIONS}
+    planned_repositories = MONGO_REPOSITORIES.count_documents(planned_filter)
+    processed_repositories = MONGO_REPOSITORIES.count_documents({**planned_filter, "processed": True})
+    stale_runs = MONGO_RUNS.count_documents(STALE_RUNS_FILTER)
+    LOGGER.info("Versions: %s", PARSING_VERSIONS)
+    LOGGER.info(
+        "%d/%d repositories processed (%0.1f%%), %d stale runs remaining",
+        processed_repositories,
+        planned_repositories,
+        100 * processed_repositories / planned_repositories if planned_repositories else 100,
+        stale_runs,
+    )
+
+
+def main():
+    """
+    Entrypoint function
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="Print progress of the reprocessing")
+    parser.add_argument("--all", action="store_true", help="Enqueue all repositories")
+    parser.add_argument("--dry-run", action="store_true", help="Count stale runs without enqueuing repositories")
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+        return
+
+    mongo_filter = {"selected": True}
+
+    # Copy repositories to a list as MongoDB cursor can expire if scraping is long
+    LOGGER.info("Fetching repositories from MongoDB...")
+    repositories = [repo["_id"] for repo in MONGO_REPOSITORIES.find(mongo_filter, projection={"_id": True})]
+    assert repositories, "Query returned no result!"
+
+    if args.all:
+        stale_runs = {repo_name: None for repo_name in repositories}
+    else:
+        LOGGER.info("Counting runs not parsed with %s...", PARSING_VERSIONS)
+        stale_runs_by_repo = count_stale_runs()
+        stale_runs = {repo_name: stale_runs_by_repo[repo_name] for repo_name in repositories if repo_name in stale_runs_by_repo}
+    LOGGER.info(
+        "%d repositories to reprocess (%d stale runs)",
+        len(stale_runs),
+        sum(count for count in stale_runs.values() if count),
+    )
+    if args.dry_run:
+        return
+
+    # Ensure RabbitMQ queue exists
+    pika_wrapper = PikaWrapper("reprocess_stale_runs")
+    pika_wrapper.channel.queue_declare(queue="repositories", durable=True)
+
+    # processed flag is set back to True by the worker (see --status)
+    repo_names = list(stale_runs)
+    random.shuffle(repo_names)
+    for repo_name in tqdm(repo_names):
+        try:
+            MONGO_REPOSITORIES.update_one(
+                {"_id": repo_name},
+                {
+                    "$set": {
+                        "processed": False,
+                        "reprocess": {
+                            "planned_at": datetime.utcnow(),
+                            "stale_runs": stale_runs[repo_name],
+                            "parsing_versions": PARSING_VERSIONS,
+                        },
+                    }
+                },
+            )
+            pika_wrapper.publish("repositories", {"repo_name": repo_name})
+        except Exception:
+            LOGGER.exception("Fail to process repo '%s'", repo_name)
+
+
+if __name__ == "__main__":
+    main()
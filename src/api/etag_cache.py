@@ -0,0 +1,145 @@
+"""
+Cache of Github API responses for conditional requests (ETag)
+
+A response with an ETag is stored, and the next identical request (same token, URL and parameters: ETags are per
+token) is sent with If-None-Match. On 304 Not Modified, which is not counted in the rate limit, the stored response is
+returned instead. Responses are stored in a SQLite database, and the least recently used responses are removed when
+the database exceeds max_size bytes or max_entries responses (checked every 100 stored responses).
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from src.tools.metrics import Counter
+
+LOGGER = logging.getLogger(__name__)
+
+# Headers of the stored response that are returned on 304 (rate limit headers are taken from the 304 response)
+STORED_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Link"]
+
+ETAG_CACHE_REQUESTS = Counter(
+    "gha_github_etag_cache_requests_total",
+    "Cacheable Github API requests (not_modified: stored response returned on 304, modified: stored response outdated, "
+    "miss: no stored response)",
+    ["result"],
+)
+
+
+class EtagCache:
+    """
+    Responses with an ETag stored in SQLite (path can be ":memory:"), shared by threads (and by processes if on disk)
+    """
+
+    def __init__(self, path: str, max_size: int = 200 * 10**6, max_entries: int = 100000) -> None:
+        """
+        max_size: maximum size of stored responses (bytes), a response larger than 1% of max_size is not stored
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.counters = {"not_modified": 0, "modified": 0, "miss": 0, "stored": 0, "evicted": 0}
+        self.puts_since_eviction = 0
+        self.lock = threading.Lock()
+        self.connection: sqlite3.Connection = None
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Open a new connection (e.g., in a forked process, as connections must not be shared between processes)
+        """
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, etag TEXT, headers TEXT, content BLOB, size INTEGER, accessed_at REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    @staticmethod
+    def key(token: str, url: str, params: Optional[Dict] = None) -> str:
+        """
+        Key of a request
+        """
+        request = json.dumps([token, url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, str], bytes]]:
+        """
+        ETag, headers and content of the stored response
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT etag, headers, content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        etag, headers, content = row
+        return etag, json.loads(headers), content
+
+    def put(self, key: str, response: requests.Response) -> None:
+        """
+        Store a response (if it has an ETag)
+        """
+        etag = response.headers.get("ETag")
+        if not etag or len(response.content) > self.max_size // 100:
+            return
+        headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, etag, json.dumps(headers), response.content, len(response.content), time.time()),
+            )
+            self.counters["stored"] += 1
+            self.puts_since_eviction += 1
+            evict = self.puts_since_eviction >= 100
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove least recently used responses until the cache is under 90% of max_size and max_entries
+        """
+        with self.lock:
+            self.puts_since_eviction = 0
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if entries <= self.max_entries and size <= self.max_size:
+                return
+            removed_entries, removed_size = 0, 0
+            for key, entry_size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+                if entries - removed_entries <= 0.9 * self.max_entries and size - removed_size <= 0.9 * self.max_size:
+                    break
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                removed_entries += 1
+                removed_size += entry_size
+            self.counters["evicted"] += removed_entries
+        LOGGER.debug("%d responses removed from ETag cache (%0.2fMB)", removed_entries, removed_size / 10**6)
+
+    def count(self, result: str) -> None:
+        """
+        Count a cacheable request (not_modified, modified or miss)
+        """
+        with self.lock:
+            self.counters[result] += 1
+        ETAG_CACHE_REQUESTS.inc(result=result)
+
+    @staticmethod
+    def cached_response(not_modified: requests.Response, headers: Dict[str, str], content: bytes) -> requests.Response:
+        """
+        Response with the stored content, returned instead of a 304 response
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response._content = content  # pylint: disable=protected-access
+        response.headers = CaseInsensitiveDict({**not_modified.headers, **headers})
+        response.headers.pop("Content-Length", None)
+        return response
@@ -2,27 +2,68 @@
 Wrapper around Github API
 """
 
+import atexit
+import fcntl
+import hashlib
+import io
+import json
 import logging
+import math
+import os
 import random
+import tempfile
+import threading
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from itertools import groupby
-from typing import Dict, List, Optional, Tuple, Union
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+
+from src.api.etag_cache import EtagCache
+from src.api.token_ledger import (
+    LOW_REMAINING,
+    MemoryLedger,
+    SharedMemoryLedger,
+    TokenLedger,
+    TokenState,
+    open_token_ledger,
+    token_id,
+)
+from src.tools.metrics import Gauge
 
 LOGGER = logging.getLogger(__name__)
 
+# Clients of this process, reported in TOKENS_REMAINING (labeled by the name of their tokens file)
+GITHUB_APIS: "weakref.WeakSet[GithubApi]" = weakref.WeakSet()
+
+TOKENS_REMAINING = Gauge(
+    "gha_github_token_remaining",
+    "Remaining API calls of Github tokens (from the last response using the token)",
+    ["api", "token"],
+    function=lambda: {
+        (github_api.name, str(i)): github_api.tokens_remaining[token]
+        for github_api in list(GITHUB_APIS)
+        for i, token in enumerate(github_api.tokens, start=1)
+        if token in github_api.tokens_remaining
+    },
+)
+
 
 class TooManyResults(Exception):
     """
     Exception raised when there is more than 1000 results
+    items: items of the first page (already returned by the API)
     """
 
-    def __init__(self, message, total_count):
+    def __init__(self, message, total_count, items=None):
         super().__init__(message)
         self.total_count = total_count
+        self.items = items or []
 
 
 class GithubApi:
@@ -34,21 +75,95 @@ class GithubApi:
 
     API_BASE_URL = "https://api.github.com/"
     MAX_ATTEMPTS = 5
-
-    def __init__(self, config_path: str = "secrets/github_thomas.yaml") -> None:
+    LOGS_SPOOL_MAX_SIZE = 5 * 10**6  # Logs archives larger than this are downloaded to disk
+    # Runs expected in each time window when runs of a repository are fetched by windows (see get_runs_by_windows)
+    WINDOW_TARGET_COUNT = 800
+    WINDOW_MIN_DURATION = 1  # Seconds
+    # Check of the rate limit of tokens on creation: "background" (tokens are checked at the same time in a thread),
+    # "sync" (same, but creation waits for the checks) or "lazy" (rate limits are only known from responses)
+    TOKEN_PROBE = os.environ.get("GITHUB_TOKEN_PROBE", "background")
+    TOKEN_PROBE_MAX_WORKERS = 16
+    # Pages fetched at the same time by get_pages (0: one page after another)
+    PAGES_MAX_WORKERS = int(os.environ.get("GITHUB_PAGES_MAX_WORKERS", "0"))
+    # Duration of the lease of a token (another token is then chosen according to remaining API calls)
+    TOKEN_LEASE_DURATION = int(os.environ.get("GITHUB_TOKEN_LEASE_DURATION", "60"))
+
+    def __init__(
+        self,
+        config_path: str = "secrets/github_thomas.yaml",
+        ledger: Optional[TokenLedger] = None,
+        probe: Optional[str] = None,
+        snapshot_path: Optional[str] = None,
+        etag_cache: Optional[EtagCache] = None,
+    ) -> None:
         """
         Etags (for conditional requests) are PER-TOKEN: 2 tokens for the same request will have different Etags!
         Therefore, use a dedicated config_path for fetcher!
+        ledger: rate limits of tokens, shared with other processes (default: see GITHUB_TOKEN_LEDGER in token_ledger.py)
+        probe: check of tokens on creation (default: TOKEN_PROBE)
+        snapshot_path: JSON file of rate limits of tokens, loaded on creation and written after the check of tokens
+        and on exit (default: GITHUB_TOKEN_SNAPSHOT, not used if not set)
+        etag_cache: responses used for conditional requests in get (default: SQLite database GITHUB_ETAG_CACHE
+        of at most GITHUB_ETAG_CACHE_MAX_SIZE bytes, not used if not set)
         """
         with open(config_path, "rt", encoding="utf-8") as fd:
             config = yaml.safe_load(fd)
 
+        self.name = os.path.splitext(os.path.basename(config_path))[0]
         self.tokens: List[str] = config["tokens"]
         assert self.tokens, "No token provided: this is not supported"
         LOGGER.debug("%d tokens found", len(self.tokens))
         self.current_token = random.choice(self.tokens)
+        self.lease_expiration = 0.0  # The current token is leased again after this epoch (see get)
+
+        # Remaining API calls and reset time of tokens, recorded from each response (see get)
+        self.ledger = ledger if ledger is not None else open_token_ledger(os.environ.get("GITHUB_TOKEN_LEDGER", "memory"))
+        self.etag_cache = etag_cache
+        if self.etag_cache is None and os.environ.get("GITHUB_ETAG_CACHE"):
+            self.etag_cache = EtagCache(
+                os.environ["GITHUB_ETAG_CACHE"],
+                max_size=int(os.environ.get("GITHUB_ETAG_CACHE_MAX_SIZE", str(200 * 10**6))),
+            )
 
+        self.session: requests.Session = None
+        self.reset_session()
+
+        self.snapshot_path = snapshot_path or os.environ.get("GITHUB_TOKEN_SNAPSHOT")
+        if self.snapshot_path:
+            self.load_snapshot()
+            atexit.register(self.save_snapshot)
+
+        # Check tokens
+        self.probe_thread: Optional[threading.Thread] = None
+        probe = probe or self.TOKEN_PROBE
+        if probe == "sync":
+            self.check_tokens()
+        elif probe == "background":
+            self.probe_thread = threading.Thread(target=self.check_tokens, name="github-token-probe", daemon=True)
+            self.probe_thread.start()
+        elif probe != "lazy":
+            raise ValueError(f"Unknown token probe: {probe}")
+        GITHUB_APIS.add(self)
+
+    @property
+    def tokens_remaining(self) -> Dict[str, int]:
+        """
+        Remaining API calls of tokens (from the last response using the token, in any process sharing the ledger)
+        """
+        return {token: state.remaining for token, state in self.ledger.token_states(self.tokens).items()}
+
+    def reset_session(self) -> None:
+        """
+        Open a new HTTP session (e.g., in a forked process, as connections must not be shared between processes)
+        """
+        self.ledger.reset()
+        if self.etag_cache is not None:
+            self.etag_cache.reset()
         self.session = requests.Session()
+        # Connections kept for concurrent requests (e.g., pages fetched at the same time, see get_pages)
+        adapter = HTTPAdapter(pool_maxsize=max(10, self.PAGES_MAX_WORKERS))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.session.headers.update(
             {
                 "Accept": "application/vnd.github.v3+json",
@@ -57,21 +172,26 @@ class GithubApi:
             }
         )
 
-        # key is token, value is epoch when the token will be available again
-        self.tokens_rate_limit_expiration: Dict[str, int] = {}
-
-        # Check tokens
-        self.check_tokens()
-
+    def share_rate_limits(self) -> None:
+        """
+        Move rate limits to shared memory if they are kept in this process: processes forked afterwards share them
+        """
+        self.wait_probe()
+        if isinstance(self.ledger, MemoryLedger):
+            self.ledger = SharedMemoryLedger(
+                self.tokens, {token_id: state for token_id, state in self.ledger.states.items()}
+            )
 
     def check_tokens(self) -> None:
         """
-        Check tokens rate limit
+        Check tokens rate limit (TOKEN_PROBE_MAX_WORKERS tokens at the same time)
         """
-        for i, token in enumerate(self.tokens, start=1):
-            self.current_token = token
-            self.session.headers.update({"Authorization": f"token {self.current_token}"})
-            req = self.get(url=GithubApi.API_BASE_URL + "rate_limit")
+        def check_token(i: int, token: str) -> None:
+            try:
+                req = self.get(url=GithubApi.API_BASE_URL + "rate_limit", token=token)
+            except (IOError, ValueError) as err:
+                LOGGER.warning("Token %d: fail to check rate limit (%s)", i, err)
+                return
             response = req.json()
             LOGGER.info(
                 "Token %d: %d/%d remaining (reset: %s)",
@@ -80,59 +200,105 @@ class GithubApi:
                 int(response["resources"]["core"]["limit"]),
                 datetime.fromtimestamp(int(response["resources"]["core"]["reset"])).isoformat(),
             )
-            if int(response["resources"]["core"]["remaining"]) == 0:
-                self.tokens_rate_limit_expiration[self.current_token] = int(response["resources"]["core"]["reset"])
+            self.ledger.record(
+                token, int(response["resources"]["core"]["remaining"]), int(response["resources"]["core"]["reset"])
+            )
+
+        with ThreadPoolExecutor(max_workers=min(self.TOKEN_PROBE_MAX_WORKERS, len(self.tokens))) as executor:
+            list(executor.map(check_token, range(1, len(self.tokens) + 1), self.tokens))
+        if self.snapshot_path:
+            self.save_snapshot()
+
+    def wait_probe(self) -> None:
+        """
+        Wait for the check of tokens started in the background
+        """
+        if self.probe_thread is not None:
+            self.probe_thread.join()
 
+    def load_snapshot(self) -> None:
+        """
+        Record rate limits of tokens saved in snapshot_path (if the file exists)
+        """
+        if not os.path.isfile(self.snapshot_path):
+            return
+        with open(self.snapshot_path, "rt", encoding="utf-8") as fd:
+            snapshot = json.load(fd)
+        token_ids = {token_id(token) for token in self.tokens}
+        self.ledger.seed({key: TokenState(*values) for key, values in snapshot.items() if key in token_ids})
+        LOGGER.debug("Rate limits of %d tokens loaded from %s", len(token_ids & set(snapshot)), self.snapshot_path)
+
+    def save_snapshot(self) -> None:
+        """
+        Write rate limits of tokens to snapshot_path (tokens are stored as hashes)
+        The snapshot is shared by clients with other tokens (e.g., fetcher clients or worker processes): it is locked
+        while it is read and merged with the rate limits of tokens of this client (newest states are kept)
+        """
+        states = {token_id(token): state for token, state in self.ledger.token_states(self.tokens).items()}
+        with open(f"{self.snapshot_path}.lock", "a", encoding="utf-8") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            snapshot = {}
+            if os.path.isfile(self.snapshot_path):
+                with open(self.snapshot_path, "rt", encoding="utf-8") as fd:
+                    snapshot = json.load(fd)
+            for key, state in states.items():
+                if key not in snapshot or state.newer_than(TokenState(*snapshot[key])):
+                    snapshot[key] = [state.remaining, state.reset]
+            with tempfile.NamedTemporaryFile(
+                "wt", dir=os.path.dirname(self.snapshot_path) or ".", suffix=".tmp", delete=False, encoding="utf-8"
+            ) as fd:
+                json.dump(snapshot, fd)
+            os.replace(fd.name, self.snapshot_path)
 
     def token_available(self) -> bool:
         """
         Check if a token is available
         """
-        for token in self.tokens:
-            token_ts = self.tokens_rate_limit_expiration.get(token)
-            if token_ts is None:
-                return True
-            if token_ts < datetime.utcnow().timestamp():
-                return True
-        return False
+        return self.available_tokens() > 0
 
+    def available_tokens(self) -> int:
+        """
+        Number of tokens that are not rate limited
+        """
+        return sum(1 for budget in self.ledger.budgets(self.tokens).values() if budget > 0)
 
     def next_token(self) -> None:
         """
-        Use another token or wait until one token is available again if all tokens are rate limited
+        Lease a token, chosen according to remaining API calls of tokens (in all processes sharing the ledger),
+        or wait until one token is available again if all tokens are rate limited
         """
-        while True:
-            candidates = []
-            for token in self.tokens:
-                token_ts = self.tokens_rate_limit_expiration.get(token)
-                if token_ts is None:  # Not rate limited
-                    candidates.append(token)
-                    continue
-                if token_ts < datetime.utcnow().timestamp():
-                    candidates.append(token)
-                    continue
-            if candidates:
-                next_token = random.choice(
-                    candidates
-                )  # Randomly choose 1 token among available tokens (useful when multiple workers use the same set of tokens)
-                break
-            LOGGER.warning(
-                "No token available: next token available at %s",
-                datetime.fromtimestamp(min(self.tokens_rate_limit_expiration.values())).isoformat(),
-            )
-            time.sleep(5)
-        self.current_token = next_token
+        self.current_token = self.ledger.lease(self.tokens)
+        self.lease_expiration = time.time() + self.TOKEN_LEASE_DURATION
         self.session.headers.update({"Authorization": f"token {self.current_token}"})
 
-    def get(self, url, params=None, headers=None, **kwargs):
+    def get(self, url, params=None, headers=None, token: Optional[str] = None, **kwargs):
         """
         Wrapper for GET
+        token: use this token instead of the leased token (e.g., to check it)
+        Responses are cached for conditional requests (see etag_cache), except streamed responses and requests with
+        their own conditional or Range headers: a 304 response is replaced by the cached response
         """
+        cacheable = self.etag_cache is not None and not kwargs.get("stream") \
+            and not any(name.lower() in ["if-none-match", "if-modified-since", "range"] for name in headers or {})
         for _ in range(self.MAX_ATTEMPTS):
             try:
-                req = self.session.get(url=url, params=params, headers=headers, **kwargs)
+                if token is None and time.time() >= self.lease_expiration:
+                    self.next_token()
+                request_token = token or self.current_token
+                # Token is set by request, as the session token can be changed by other threads (see next_token)
+                request_headers, cached = {**(headers or {}), "Authorization": f"token {request_token}"}, None
+                if cacheable:
+                    cache_key = self.etag_cache.key(request_token, url, params)
+                    cached = self.etag_cache.get(cache_key)
+                    if cached is not None:
+                        request_headers["If-None-Match"] = cached[0]
+                req = self.session.get(url=url, params=params, headers=request_headers, **kwargs)
                 # LOGGER.info("headers: %s", req.headers.items())
-                if int(req.headers.get('X-RateLimit-Remaining', "5000")) < 50:
+                if "X-RateLimit-Remaining" in req.headers and "X-RateLimit-Reset" in req.headers:
+                    self.ledger.record(
+                        request_token, int(req.headers["X-RateLimit-Remaining"]), int(req.headers["X-RateLimit-Reset"])
+                    )
+                if token is None and int(req.headers.get("X-RateLimit-Remaining", "5000")) < LOW_REMAINING:
                     # We proactively use another token to avoid reaching the rate limit
                     LOGGER.debug("Less than 50 API calls with this token, using another token now to avoid being rate-limited")
                     self.next_token()
@@ -140,14 +306,20 @@ class GithubApi:
                 LOGGER.warning("Exception raised: %s", exception)
                 continue
             if req.ok:  # 2-3xx codes
+                if cacheable:
+                    if req.status_code == 304 and cached is not None:
+                        self.etag_cache.count("not_modified")
+                        return self.etag_cache.cached_response(req, cached[1], cached[2])
+                    self.etag_cache.count("modified" if cached is not None else "miss")
+                    self.etag_cache.put(cache_key, req)
                 return req
             if req.status_code >= 500:  # Try again
                 time.sleep(1)
                 continue
             if req.headers.get("X-RateLimit-Remaining", -1) == "0":  # we are rate-limited (HTTP 403)
-                LOGGER.debug("We got rate limited: using another token")
-                self.tokens_rate_limit_expiration[self.current_token] = int(req.headers["X-RateLimit-Reset"])
-                self.next_token()
+                if token is not None:
+                    raise IOError("Token is rate limited")
+                LOGGER.debug("We got rate limited: using another token")  # Rate limit was recorded in the ledger
                 continue
             if req.status_code >= 400:  # HTTP 4xx: that will probably not work even with other attempts
                 LOGGER.warning("Got HTTP %d: %s", req.status_code, req.text)
@@ -161,10 +333,15 @@ class GithubApi:
         strict: bool = True,
         list_key: str = "items",
         limit: int = None,
+        warn_incomplete: bool = True,
+        parallel: Optional[int] = None,
     ):
         """
         Github API is paginated: loop over pages
         strict: raise an exception if there is more than 1000 results (as they cannot be all retrieved)
+        warn_incomplete: log a warning if less items than total_count are returned
+        parallel: number of pages fetched at the same time when total_count is returned (default: PAGES_MAX_WORKERS,
+        0: pages are fetched one after another, only when the previous page is consumed)
         """
         counter = 0
         req = self.get(url=url, params=params)
@@ -174,6 +351,7 @@ class GithubApi:
             raise TooManyResults(
                 f"{total_count} > 1000 items returned: results will be incomplete",
                 total_count,
+                req_json.get(list_key),
             )
 
         if list_key not in req_json:
@@ -181,6 +359,12 @@ class GithubApi:
         for item in req_json[list_key]:
             counter += 1
             yield item
+
+        parallel = self.PAGES_MAX_WORKERS if parallel is None else parallel
+        if parallel > 0 and total_count > 0 and "next" in req.links:
+            yield from self.get_next_pages(url, params, req_json[list_key], total_count, list_key, limit, parallel)
+            return
+
         while "next" in req.links:
             LOGGER.debug("%d over %d", counter, total_count)
             req = self.get(url=req.links["next"]["url"])
@@ -189,13 +373,61 @@ class GithubApi:
                     return
                 counter += 1
                 yield item
-        if counter < total_count:
+        if warn_incomplete and counter < total_count:
             LOGGER.warning(
                 "%d items returned over %d: try to narrow down the set of results",
                 counter,
                 total_count,
             )
 
+    def get_next_pages(
+        self,
+        url: str,
+        params: Dict[str, Union[str, int, float]],
+        first_page: List[Dict],
+        total_count: int,
+        list_key: str,
+        limit: int = None,
+        parallel: int = 1,
+    ) -> Iterator[Dict]:
+        """
+        Fetch pages following first_page at the same time (page URLs are known from total_count and per_page),
+        and yield their items in page order
+        Items with an id are deduplicated: if items are added while pages are fetched, items are shifted to next pages
+        (an item can be returned twice, and the last items can be shifted to the page after the last page)
+        """
+        per_page = int(params.get("per_page", 30))
+        pages = math.ceil(min(total_count, 1000) / per_page)
+        seen_ids = {item["id"] for item in first_page if "id" in item}
+        counter = len(first_page)
+
+        def get_page(page: int) -> List[Dict]:
+            return self.get(url=url, params={**params, "page": page}).json()[list_key]
+
+        executor = ThreadPoolExecutor(max_workers=min(parallel, pages - 1 or 1), thread_name_prefix="github-pages")
+        try:
+            futures = [executor.submit(get_page, page) for page in range(2, pages + 1)]
+            # Items shifted after the last page (only if the API can return it)
+            if pages * per_page < 1000:
+                futures.append(None)
+            for page, future in enumerate(futures, start=2):
+                if future is None:
+                    if counter >= min(total_count, 1000):
+                        break
+                    LOGGER.debug("%d items over %d: fetching page %d for shifted items", counter, total_count, page)
+                    future = executor.submit(get_page, page)
+                for item in future.result():
+                    if "id" in item:
+                        if item["id"] in seen_ids:
+                            continue
+                        seen_ids.add(item["id"])
+                    if limit and counter >= limit:
+                        return
+                    counter += 1
+                    yield item
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def check_new_runs(self, full_name: str, etag: str) -> Tuple[Optional[bool], str]:
         """
         Check for new runs using Etag
@@ -217,6 +449,18 @@ class GithubApi:
             return req.status_code != 304, req.headers.get("Etag")  # 304 Not Modified if Etag matches
         return None, req.headers.get("Etag")
 
+    def get_workflows(self, full_name: str) -> List[Dict]:
+        """
+        Workflows of a repository (path, state...)
+        """
+        return list(
+            self.get_pages(
+                GithubApi.API_BASE_URL + f"repos/{full_name}/actions/workflows",
+                params={"per_page": 100},
+                list_key="workflows",
+            )
+        )
+
     def get_workflow_runs(
         self,
         full_name: str,
@@ -235,69 +479,11 @@ class GithubApi:
         if not from_date:
             from_date = datetime.now() - timedelta(days=90)
 
-        if to_date and from_date:
-            created_query = "{}..{}".format(
-                from_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
-                to_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
-            )
-        else:
-            created_query = ">{}".format(from_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
-
         runs = []
         try:
-            runs.extend(
-                self.get_pages(
-                    GithubApi.API_BASE_URL + f"repos/{full_name}/actions/runs",
-                    params={
-                        "status": status,
-                        "created": created_query,
-                        "per_page": 100,
-                    },
-                    list_key="workflow_runs",
-                    limit=limit,
-                )
-            )
+            runs.extend(self.get_runs_in_window(full_name, status, from_date, to_date, limit=limit))
         except TooManyResults as err:
-            periods = (
-                int(err.total_count / 800) + 1
-            )  # Runs might not be equally distributed, so we take a 25% margin to try to avoid further splitting (API calls are costly)
-
-            LOGGER.info(
-                "%d results found: splitting time range into %d chunks",
-                err.total_count,
-                periods,
-            )
-
-            for i in range(1, 1000):  # Runs might not be uniformly distributed, so we might have to split again
-                for _from_date, _to_date in self.split_time_range(from_date, to_date, periods):
-                    try:
-                        LOGGER.debug("Fetching runs from %s to %s...", _from_date, _to_date)
-                        _runs = self.get_workflow_runs(
-                            full_name,
-                            status,
-                            _to_date,
-                            _from_date,
-                            group_by_workflow=False,
-                        )
-                        LOGGER.debug("%d runs found", len(_runs))
-                        runs.extend(_runs)
-                    except TooManyResults as _err:
-                        LOGGER.debug(
-                            "Still to many results (%d), splitting into smaller chunks... (periods %d -> %d)",
-                            _err.total_count,
-                            periods,
-                            periods + 1,
-                        )
-                        runs = []
-                        periods += 1
-                        break
-                    if limit and len(runs) > limit:
-                        break
-                if runs:
-                    break
-                if i >= 999:
-                    LOGGER.error("The maximum recursion 1000 has been exhausted, exiting the loop...")
-                    break
+            runs = self.get_runs_by_windows(full_name, status, from_date, to_date or datetime.now(), err, limit)
 
         # Remove duplicates as API might return duplicates when using pagination (Hello GH)
         runs = list({run["id"]: run for run in runs}.values())
@@ -310,6 +496,161 @@ class GithubApi:
 
         return runs
 
+    def iter_workflow_runs(
+        self,
+        full_name: str,
+        status: str = "completed",
+        from_date: datetime = None,
+        to_date: datetime = None,
+        until: Optional[Callable[[Dict], bool]] = None,
+        limit: int = None,
+    ) -> Iterator[Dict]:
+        """
+        Yield workflow runs newest first, one page after another (pages are only fetched when the previous one is consumed)
+        Runs are deduplicated (the API can return a run on 2 pages when new runs are created during pagination)
+        until: stop before the first run for which it returns True (e.g., a run already scraped)
+        limit: stop after this number of runs
+        from_date: if not defined, from_date will be equal to 90d ago (as logs are kept 90d by default)
+        As the API returns at most 1000 runs by query, runs older than the 1000th run are queried again
+        """
+        if not from_date:
+            from_date = datetime.now() - timedelta(days=90)
+
+        seen_ids = set()
+        window_end = to_date
+        while True:
+            window_runs = 0
+            oldest_run = None
+            for run in self.get_runs_pages(full_name, status, from_date, window_end, warn_incomplete=False, parallel=0):
+                window_runs += 1
+                oldest_run = min(oldest_run or run["created_at"], run["created_at"])
+                if run["id"] in seen_ids:
+                    continue
+                if until is not None and until(run):
+                    return
+                seen_ids.add(run["id"])
+                yield run
+                if limit and len(seen_ids) >= limit:
+                    return
+
+            if window_runs < 1000:
+                return
+            # Query runs up to the oldest run returned (included, as other runs can be created in the same second)
+            next_window_end = datetime.strptime(oldest_run, "%Y-%m-%dT%H:%M:%SZ")
+            if window_end is not None and next_window_end >= window_end:
+                LOGGER.warning("More than 1000 runs created at %s: some runs are ignored", oldest_run)
+                next_window_end = window_end - timedelta(seconds=1)
+            window_end = next_window_end
+
+    @staticmethod
+    def created_query(from_date: datetime, to_date: Optional[datetime] = None) -> str:
+        """
+        Value of the created parameter of a time window
+        """
+        if to_date:
+            return "{}..{}".format(
+                from_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+                to_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            )
+        return ">{}".format(from_date.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+
+    def get_runs_in_window(
+        self,
+        full_name: str,
+        status: str,
+        from_date: datetime,
+        to_date: Optional[datetime] = None,
+        strict: bool = True,
+        limit: int = None,
+    ) -> List[Dict]:
+        """
+        Get runs created in a time window
+        Raise TooManyResults if there is more than 1000 runs (unless strict is False)
+        """
+        return list(self.get_runs_pages(full_name, status, from_date, to_date, strict=strict, limit=limit))
+
+    def get_runs_pages(
+        self,
+        full_name: str,
+        status: str,
+        from_date: datetime,
+        to_date: Optional[datetime] = None,
+        strict: bool = False,
+        limit: int = None,
+        warn_incomplete: bool = True,
+        parallel: Optional[int] = None,
+    ) -> Iterator[Dict]:
+        """
+        Yield runs created in a time window, as returned by the API (newest first, at most 1000 runs)
+        parallel: see get_pages
+        """
+        return self.get_pages(
+            GithubApi.API_BASE_URL + f"repos/{full_name}/actions/runs",
+            params={
+                "status": status,
+                "created": self.created_query(from_date, to_date),
+                "per_page": 100,
+            },
+            strict=strict,
+            list_key="workflow_runs",
+            limit=limit,
+            warn_incomplete=warn_incomplete,
+            parallel=parallel,
+        )
+
+    def get_runs_by_windows(
+        self,
+        full_name: str,
+        status: str,
+        from_date: datetime,
+        to_date: datetime,
+        error: TooManyResults,
+        limit: int = None,
+    ) -> List[Dict]:
+        """
+        Get runs of a time range with more than 1000 runs (error raised for this range), one time window after another
+        (newest first)
+        A window with more than 1000 runs is split into windows of about WINDOW_TARGET_COUNT runs according to its
+        total_count: only this window is fetched again, runs of completed windows are kept
+        The first page of an overflowing window (newest runs) is kept: the window then ends at its oldest run
+        If the window does not shrink (e.g., more than 100 runs in its last second), it is split
+        """
+        runs = {}  # By id, as windows share their bounds and runs of the first page of a window can be fetched again
+        windows = []  # Stack of windows to fetch, with their total_count if known
+
+        def add_overflowing_window(window_start: datetime, window_end: datetime, error: TooManyResults) -> None:
+            runs.update((run["id"], run) for run in error.items)
+            window_count = error.total_count - len(error.items)
+            if error.items:
+                oldest_run = min(datetime.strptime(run["created_at"], "%Y-%m-%dT%H:%M:%SZ") for run in error.items)
+                oldest_run = max(window_start, min(window_end, oldest_run))  # Runs of this second may be fetched twice
+                if oldest_run < window_end:
+                    windows.append((window_start, oldest_run, window_count))
+                    return
+            windows.append((window_start, window_end, error.total_count))
+
+        add_overflowing_window(from_date, to_date, error)
+        while windows and not (limit and len(runs) >= limit):
+            window_start, window_end, window_count = windows.pop()
+            duration = (window_end - window_start).total_seconds()
+            if window_count is not None and window_count > 1000 and duration > self.WINDOW_MIN_DURATION:
+                # Split window (oldest windows are pushed first, so that newest runs are fetched first)
+                periods = min(math.ceil(window_count / self.WINDOW_TARGET_COUNT), math.ceil(duration / self.WINDOW_MIN_DURATION))
+                LOGGER.debug("%d runs from %s to %s: splitting into %d windows", window_count, window_start, window_end, periods)
+                windows.extend((start, end, None) for start, end in self.split_time_range(window_start, window_end, periods))
+                continue
+            try:
+                # Windows of WINDOW_MIN_DURATION with more than 1000 runs cannot be split: first 1000 runs are fetched
+                window_runs = self.get_runs_in_window(
+                    full_name, status, window_start, window_end, strict=duration > self.WINDOW_MIN_DURATION
+                )
+            except TooManyResults as err:
+                add_overflowing_window(window_start, window_end, err)
+                continue
+            LOGGER.debug("%d runs found from %s to %s", len(window_runs), window_start, window_end)
+            runs.update((run["id"], run) for run in window_runs)
+        return list(runs.values())
+
     @staticmethod
     def split_time_range(from_date: datetime, to_date: datetime, periods: int):
         """
@@ -325,7 +666,7 @@ class GithubApi:
             ]
             for i in range(periods)
         ]
-        LOGGER.info(
+        LOGGER.debug(
             "Splitting %s to %s into %d periods: %s",
             from_date,
             to_date,
@@ -334,21 +675,56 @@ class GithubApi:
         )
         return ranges
 
-    def get_logs(self, logs_url: str, max_size: int = 20*10**6) -> bytes:
+    def download_logs(
+        self,
+        logs_url: str,
+        fd: Optional[BinaryIO] = None,
+        max_size: int = 20*10**6,
+        checksum: Optional[str] = None,
+        max_resumes: int = 3,
+    ) -> Tuple[BinaryIO, Optional[str]]:
         """
-        Get step logs (ZIP archive)
+        Download step logs (ZIP archive) to fd, or to a spooled temporary file if fd is not provided
+        If the connection is reset, download is resumed with a HTTP Range request (up to max_resumes times)
+        checksum: hashlib algorithm (e.g., "sha256") used to compute the digest of the archive while downloading
+        Return fd positioned at the start of the archive, and the digest (None if checksum is not set)
         Exception will be raised by self.get on HTTP 4xx
         """
+        if fd is None:
+            fd = tempfile.SpooledTemporaryFile(max_size=self.LOGS_SPOOL_MAX_SIZE)
+        start_position = fd.tell()
+        digest = hashlib.new(checksum) if checksum else None
+
         start_time = time.time()
-        req = self.get(url=logs_url, stream=True)
-        content = b''
         content_size = 0
-        for chunk in req.iter_content(chunk_size=16384):
-            content_size += len(chunk)
-            if content_size > max_size:
-                LOGGER.warning("Logs archive is too big: aborting download")
-                raise IOError("Logs archive is too big")
-            content += chunk
+        for attempt in range(max_resumes + 1):
+            req = self.get(url=logs_url, headers={"Range": f"bytes={content_size}-"} if content_size else None, stream=True)
+            try:
+                if content_size and req.status_code != 206:  # Range not honored: download from scratch
+                    LOGGER.debug("Range request not supported: downloading logs archive from scratch")
+                    fd.seek(start_position)
+                    fd.truncate()
+                    content_size = 0
+                    digest = hashlib.new(checksum) if checksum else None
+                if content_size + int(req.headers.get("Content-Length", "0")) > max_size:
+                    LOGGER.warning("Logs archive is too big: aborting download")
+                    raise IOError("Logs archive is too big")
+                for chunk in req.iter_content(chunk_size=65536):
+                    content_size += len(chunk)
+                    if content_size > max_size:
+                        LOGGER.warning("Logs archive is too big: aborting download")
+                        raise IOError("Logs archive is too big")
+                    fd.write(chunk)
+                    if digest:
+                        digest.update(chunk)
+                break
+            except requests.exceptions.RequestException as exception:
+                if attempt == max_resumes:
+                    raise
+                LOGGER.warning("Logs download interrupted after %d bytes (%s): resuming", content_size, exception)
+            finally:
+                req.close()
+
         download_duration_ms = (time.time() - start_time) * 1000
         LOGGER.debug(
             "Logs archive of %0.2fMB downloaded in %dms (%0.2fMB/s)",
@@ -357,7 +733,16 @@ class GithubApi:
             content_size / 1024**2 / (download_duration_ms / 1000),
             extra={"logs_url": logs_url, "duration_ms": download_duration_ms, "size": content_size},
         )
-        return content
+        fd.seek(start_position)
+        return fd, digest.hexdigest() if digest else None
+
+    def get_logs(self, logs_url: str, max_size: int = 20*10**6) -> bytes:
+        """
+        Get step logs (ZIP archive) in memory
+        Exception will be raised by self.get on HTTP 4xx
+        """
+        fd, _ = self.download_logs(logs_url, fd=io.BytesIO(), max_size=max_size)
+        return fd.getvalue()
 
     def get_diff(self, full_name, base, head):
         """
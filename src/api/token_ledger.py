@@ -0,0 +1,336 @@
+"""
+Ledger of the rate limits of Github tokens, shared by the processes using the same tokens
+
+Each response updates the remaining API calls and the reset time of its token (see GithubApi.get), and tokens are
+leased at random, weighted by their remaining budget, so that processes spread their calls over all tokens.
+When no token has API calls left, lease waits until the first reset time.
+
+Backends (GITHUB_TOKEN_LEDGER):
+- memory (default): rate limits of this process (shared with processes forked after GithubApi.share_rate_limits)
+- file:<path>: JSON file locked with flock, for processes of a single node
+- mongodb: collection of MongoDB (MONGODB_HOST, MONGODB_PORT)
+- redis://<host>:<port>/<db>: hash in Redis (requires the redis package)
+Tokens are stored as hashes in shared backends.
+"""
+
+import abc
+import fcntl
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+LOGGER = logging.getLogger(__name__)
+
+# Remaining API calls assumed for a token never seen or whose rate limit was reset
+RATE_LIMIT = 5000
+# Tokens with fewer remaining API calls are only leased if no other token is available
+LOW_REMAINING = 50
+
+
+def token_id(token: str) -> str:
+    """
+    Identifier of a token in the ledger (tokens are not stored in shared backends)
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+@dataclass
+class TokenState:
+    """
+    Remaining API calls of a token until reset (epoch)
+    """
+
+    remaining: int
+    reset: int
+
+    def newer_than(self, other: "TokenState") -> bool:
+        """
+        True if this state was observed after other (responses can be received out of order)
+        """
+        return self.reset > other.reset or (self.reset == other.reset and self.remaining < other.remaining)
+
+    def budget(self, now: float) -> int:
+        """
+        Remaining API calls at now
+        """
+        return RATE_LIMIT if self.reset <= now else self.remaining
+
+
+class TokenLedger(abc.ABC):
+    """
+    Token states cached in this process and synchronized with a backend (load and store)
+    States are read from the backend at most every sync_interval seconds, and written at most every sync_interval
+    seconds by token, unless the token reaches LOW_REMAINING or its rate limit is reset
+    """
+
+    def __init__(self, sync_interval: float = 0) -> None:
+        self.sync_interval = sync_interval
+        self.states: Dict[str, TokenState] = {}  # By token id
+        self.loaded_at = 0.0
+        self.stored_at: Dict[str, float] = {}  # By token id
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def load(self) -> Dict[str, TokenState]:
+        """
+        States of all tokens in the backend
+        """
+
+    @abc.abstractmethod
+    def store(self, key: str, state: TokenState) -> None:
+        """
+        Write the state of a token to the backend, unless the backend has a newer state
+        """
+
+    def reset(self) -> None:
+        """
+        Reopen connections to the backend (e.g., in a forked process)
+        """
+
+    def record(self, token: str, remaining: int, reset: int) -> None:
+        """
+        Record the rate limit of a token returned by Github API
+        """
+        key, state, now = token_id(token), TokenState(remaining, reset), time.time()
+        with self.lock:
+            previous_state = self.states.get(key)
+            if previous_state is not None and not state.newer_than(previous_state):
+                return
+            self.states[key] = state
+            store = (
+                previous_state is None
+                or previous_state.reset != reset
+                or remaining <= LOW_REMAINING
+                or now - self.stored_at.get(key, 0) >= self.sync_interval
+            )
+            if store:
+                self.stored_at[key] = now
+        if store:
+            self.store(key, state)
+
+    def seed(self, states: Dict[str, TokenState]) -> None:
+        """
+        Record states by token id (e.g., from a snapshot), unless newer states are known
+        """
+        for key, state in states.items():
+            with self.lock:
+                if key in self.states and not state.newer_than(self.states[key]):
+                    continue
+                self.states[key] = state
+            self.store(key, state)
+
+    def token_states(self, tokens: Iterable[str], refresh: bool = False) -> Dict[str, TokenState]:
+        """
+        States of tokens (tokens never seen are not included)
+        refresh: read states from the backend even if they were read less than sync_interval seconds ago
+        """
+        if refresh or time.time() - self.loaded_at >= self.sync_interval:
+            loaded_states = self.load()
+            with self.lock:
+                for key, state in loaded_states.items():
+                    if key not in self.states or state.newer_than(self.states[key]):
+                        self.states[key] = state
+                self.loaded_at = time.time()
+        with self.lock:
+            return {token: self.states[token_id(token)] for token in tokens if token_id(token) in self.states}
+
+    def budgets(self, tokens: List[str], refresh: bool = False) -> Dict[str, int]:
+        """
+        Remaining API calls of tokens
+        """
+        states, now = self.token_states(tokens, refresh=refresh), time.time()
+        return {token: states[token].budget(now) if token in states else RATE_LIMIT for token in tokens}
+
+    def lease(self, tokens: List[str]) -> str:
+        """
+        Choose a token at random, weighted by remaining API calls
+        If all tokens are rate limited, wait until the first reset
+        """
+        refresh = False
+        while True:
+            budgets = self.budgets(tokens, refresh=refresh)
+            candidates = {token: budget for token, budget in budgets.items() if budget > LOW_REMAINING} \
+                or {token: budget for token, budget in budgets.items() if budget > 0}
+            if candidates:
+                return random.choices(list(candidates), weights=list(candidates.values()))[0]
+
+            next_reset = min(state.reset for state in self.token_states(tokens).values())
+            LOGGER.warning("No token available: next token available at %s", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(next_reset)))
+            time.sleep(max(0, next_reset - time.time()) + 1)  # 1s margin for clock differences with Github
+            refresh = True
+
+
+class MemoryLedger(TokenLedger):
+    """
+    Token states of this process
+    """
+
+    def load(self) -> Dict[str, TokenState]:
+        return {}  # States are only in cache
+
+    def store(self, key: str, state: TokenState) -> None:
+        pass
+
+
+class SharedMemoryLedger(TokenLedger):
+    """
+    Token states in shared memory: processes forked after its creation see the states recorded by each other
+    """
+
+    def __init__(self, tokens: List[str], states: Optional[Dict[str, TokenState]] = None) -> None:
+        super().__init__()
+        self.indexes = {token_id(token): i for i, token in enumerate(tokens)}
+        self.shared_states = multiprocessing.Array("d", 2 * len(tokens))  # remaining and reset by token (reset 0: unknown)
+        for key, state in (states or {}).items():
+            self.store(key, state)
+
+    def load(self) -> Dict[str, TokenState]:
+        with self.shared_states.get_lock():
+            values = list(self.shared_states)
+        return {
+            key: TokenState(int(values[2 * i]), int(values[2 * i + 1]))
+            for key, i in self.indexes.items()
+            if values[2 * i + 1]
+        }
+
+    def store(self, key: str, state: TokenState) -> None:
+        i = self.indexes[key]
+        with self.shared_states.get_lock():
+            stored_state = TokenState(int(self.shared_states[2 * i]), int(self.shared_states[2 * i + 1]))
+            if not stored_state.reset or state.newer_than(stored_state):
+                self.shared_states[2 * i], self.shared_states[2 * i + 1] = state.remaining, state.reset
+
+
+class FileLedger(TokenLedger):
+    """
+    Token states in a JSON file ({<token id>: [remaining, reset]}), locked while it is read or written
+    """
+
+    def __init__(self, path: str, sync_interval: float = 1) -> None:
+        super().__init__(sync_interval)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def load(self) -> Dict[str, TokenState]:
+        with open(self.path, "a+t", encoding="utf-8") as fd:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            fd.seek(0)
+            content = fd.read()
+        return {key: TokenState(*values) for key, values in json.loads(content or "{}").items()}
+
+    def store(self, key: str, state: TokenState) -> None:
+        with open(self.path, "a+t", encoding="utf-8") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.seek(0)
+            states = json.loads(fd.read() or "{}")
+            if key not in states or state.newer_than(TokenState(*states[key])):
+                states[key] = [state.remaining, state.reset]
+                fd.seek(0)
+                fd.truncate()
+                json.dump(states, fd)
+
+
+class MongoLedger(TokenLedger):
+    """
+    Token states in a MongoDB collection ({_id: <token id>, remaining, reset})
+    """
+
+    def __init__(self, sync_interval: float = 2) -> None:
+        super().__init__(sync_interval)
+        self.collection = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.collection = pymongo.MongoClient(
+            host=os.environ.get("MONGODB_HOST", "127.0.0.1"),
+            port=int(os.environ.get("MONGODB_PORT", "27017")),
+        )["gha-scraper"]["github_tokens"]
+
+    def load(self) -> Dict[str, TokenState]:
+        return {document["_id"]: TokenState(document["remaining"], document["reset"]) for document in self.collection.find()}
+
+    def store(self, key: str, state: TokenState) -> None:
+        try:
+            self.collection.update_one(
+                {
+                    "_id": key,
+                    "$or": [
+                        {"reset": {"$lt": state.reset}},
+                        {"reset": state.reset, "remaining": {"$gt": state.remaining}},
+                    ],
+                },
+                {"$set": {"remaining": state.remaining, "reset": state.reset}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            pass  # The stored state is newer
+
+
+class RedisLedger(TokenLedger):
+    """
+    Token states in a Redis hash (<token id>: "<remaining> <reset>")
+    """
+
+    KEY = "gha-scraper:github_tokens"
+    # Set the state of a token unless the stored state is newer (see TokenState.newer_than)
+    STORE_SCRIPT = """
+local stored = redis.call('HGET', KEYS[1], ARGV[1])
+if stored then
+    local remaining, reset = string.match(stored, '(%d+) (%d+)')
+    remaining, reset = tonumber(remaining), tonumber(reset)
+    local new_remaining, new_reset = tonumber(ARGV[2]), tonumber(ARGV[3])
+    if new_reset < reset or (new_reset == reset and new_remaining >= remaining) then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ' ' .. ARGV[3])
+return 1
+"""
+
+    def __init__(self, url: str, sync_interval: float = 1) -> None:
+        super().__init__(sync_interval)
+        self.url = url
+        self.client = None
+        self.store_script = None
+        self.reset()
+
+    def reset(self) -> None:
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self.client = redis.Redis.from_url(self.url)
+        self.store_script = self.client.register_script(self.STORE_SCRIPT)
+
+    def load(self) -> Dict[str, TokenState]:
+        return {
+            key.decode(): TokenState(*(int(value) for value in values.split()))
+            for key, values in self.client.hgetall(self.KEY).items()
+        }
+
+    def store(self, key: str, state: TokenState) -> None:
+        self.store_script(keys=[self.KEY], args=[key, state.remaining, state.reset])
+
+
+def open_token_ledger(backend: str) -> TokenLedger:
+    """
+    Ledger of a backend (see GITHUB_TOKEN_LEDGER)
+    """
+    if backend == "memory":
+        return MemoryLedger()
+    if backend.startswith("file:"):
+        return FileLedger(backend[len("file:"):])
+    if backend == "mongodb":
+        return MongoLedger()
+    if backend.startswith("redis://"):
+        return RedisLedger(backend)
+    raise ValueError(f"Unknown token ledger: {backend}")
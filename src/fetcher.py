@@ -4,15 +4,21 @@ Scrape runs from repositories, store them into MongoDB and push repo name to Rab
 
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Dict, List, Tuple
 
 import pymongo
-from pymongo.errors import DuplicateKeyError
 from pythonjsonlogger import jsonlogger
 from tqdm import tqdm
 
 from src.api.github import GithubApi
+from src.tools.metrics import Counter, Gauge, Histogram, start_http_server
+from src.tools.mongo import DUPLICATE_KEY_ERROR, MONGO_DURATION, BulkWriter
 from src.tools.mq import PikaWrapper
+from src.tools.retention import RetentionPolicy, RetentionTracker
 
 # Setup logging
 logging.basicConfig(
@@ -37,40 +43,79 @@ MONGO_CLIENT = pymongo.MongoClient(
 MONGO_REPOSITORIES = MONGO_CLIENT["gha-scraper"]["repositories"]
 MONGO_RUNS = MONGO_CLIENT["gha-scraper"]["runs"]
 
-PIKA_WRAPPER = PikaWrapper("fetcher")
+# Clients created on first use (see get_clients), so that importing this module does not connect to RabbitMQ or check tokens
+PIKA_WRAPPER: PikaWrapper = None
+GITHUB_API_ONE_TOKEN: GithubApi = None
+GITHUB_API_POOL_TOKENS: GithubApi = None
 
-GITHUB_API_ONE_TOKEN = GithubApi(config_path="secrets/github_fetcher.yaml")
-GITHUB_API_POOL_TOKENS = GithubApi()
+# Runs kept for each workflow (same policy as the worker): other runs are not inserted
+RETENTION_POLICY = RetentionPolicy.from_env()
+# Conclusions of runs that have a log (i.e., not pending, action_required or similar runs)
+COMPLETED_CONCLUSIONS = ["success", "failure", "timed_out"]
 
+# Number of repositories processed at the same time
+FETCHER_CONCURRENCY = int(os.environ.get("FETCHER_CONCURRENCY", "8"))
+# pika connections are not thread-safe: messages are published one at a time
+PUBLISH_LOCK = threading.Lock()
 
-def process_repo(repo) -> None:
+# Port of the metrics endpoint (not served if not set)
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+
+# Metrics
+REPOSITORY_DURATION = Histogram("gha_fetcher_repository_duration_seconds", "Duration of the scraping of a repository")
+REPOSITORIES = Counter("gha_fetcher_repositories_total", "Processed repositories", ["result"])
+RUNS = Counter("gha_fetcher_runs_total", "Runs returned by Github API", ["result"])
+ERRORS = Counter("gha_fetcher_errors_total", "Errors", ["stage"])
+CYCLES = Counter("gha_fetcher_cycles_total", "Completed cycles over selected repositories")
+CYCLE_DURATION = Gauge("gha_fetcher_cycle_duration_seconds", "Duration of the last cycle over selected repositories")
+
+
+def get_clients() -> Tuple[PikaWrapper, GithubApi, GithubApi]:
+    """
+    RabbitMQ client, Github API client with the fetcher token (for conditional requests) and with the pool of tokens
+    """
+    global PIKA_WRAPPER, GITHUB_API_ONE_TOKEN, GITHUB_API_POOL_TOKENS  # pylint: disable=global-statement
+    if PIKA_WRAPPER is None:
+        PIKA_WRAPPER = PikaWrapper("fetcher")
+    if GITHUB_API_ONE_TOKEN is None:
+        GITHUB_API_ONE_TOKEN = GithubApi(config_path="secrets/github_fetcher.yaml")
+    if GITHUB_API_POOL_TOKENS is None:
+        GITHUB_API_POOL_TOKENS = GithubApi()
+    return PIKA_WRAPPER, GITHUB_API_ONE_TOKEN, GITHUB_API_POOL_TOKENS
+
+
+def process_repo(repo) -> str:
     """
     Process a repo
+    Return result (not_modified or success)
     """
 
     logger = logging.LoggerAdapter(LOGGER, extra={"repo_name": repo["_id"]})
+    pika_wrapper, github_api_one_token, github_api_pool_tokens = get_clients()
 
 
     # Check if there is new runs using conditional requests (Etag)
     etag_db = MONGO_REPOSITORIES.find_one({"_id": repo["_id"]}, projection={"etag": True}).get("etag")
-    new_runs_present, etag = GITHUB_API_ONE_TOKEN.check_new_runs(repo["_id"], etag_db)
+    new_runs_present, etag = github_api_one_token.check_new_runs(repo["_id"], etag_db)
 
     if new_runs_present is False:
         logger.info("Etag matched: no new run to scrape")
-        return
+        REPOSITORIES.inc(result="not_modified")
+        return "not_modified"
 
     # If Etag was not defined or a new etag was returned: update Etag in db
     MONGO_REPOSITORIES.update_one({"_id": repo["_id"]}, {"$set": {"etag": etag}})
 
     # Scrape runs only until the latest imported run
-    latest_scraped_run = next(
-            MONGO_RUNS.find(
-            {"repository_name": repo["_id"]},
-            projection={"metadata.created_at": True},
-            sort=[("metadata.created_at", -1)],
-            limit=1
+    with MONGO_DURATION.time(operation="latest_run"):
+        latest_scraped_run = next(
+                MONGO_RUNS.find(
+                {"repository_name": repo["_id"]},
+                projection={"metadata.created_at": True},
+                sort=[("metadata.created_at", -1)],
+                limit=1
+            )
         )
-    )
     logger.info("latest scraped run: %s", latest_scraped_run)
 
     if latest_scraped_run and not os.environ.get("FORCE_SCRAPE_ALL_RUNS") == "true":
@@ -79,20 +124,44 @@ def process_repo(repo) -> None:
         LOGGER.info("No previous run for %s or FORCE_SCRAPE_ALL_RUNS enabled", repo["_id"])
         from_date = None  # Default to -90d
 
-    new_runs = GITHUB_API_POOL_TOKENS.get_workflow_runs(repo["_id"], from_date=from_date, group_by_workflow=False, limit=10000)
+    # Runs are streamed newest first: pages are fetched until from_date or the limit is reached, or until older runs
+    # would be discarded by the retention policy
+    retention_tracker = RetentionTracker(
+        RETENTION_POLICY, lambda: [workflow["path"] for workflow in github_api_pool_tokens.get_workflows(repo["_id"])]
+    )
+    new_runs = []
+    for run in github_api_pool_tokens.iter_workflow_runs(
+        repo["_id"], from_date=from_date, until=retention_tracker.complete, limit=10000
+    ):
+        new_runs.append(run)
+        if run["conclusion"] in COMPLETED_CONCLUSIONS:
+            retention_tracker.add(run)
     logger.info("%d new runs found for %s", len(new_runs), repo["_id"])
 
-    inserted_runs_count = 0
+    def on_insert_error(write_error):
+        if write_error["code"] == DUPLICATE_KEY_ERROR:
+            logger.warning("%s already imported", write_error["op"]["_id"])
+        else:
+            logger.error("Fail to insert %s: %s", write_error["op"]["_id"], write_error["errmsg"])
+            ERRORS.inc(stage="mongo_write")
+
+    # We are only interested in runs that have a log, i.e., not pending, action_required or similar runs
+    # Don't insert action_required runs else they will not be inserted later because DuplicateKeyError
+    completed_runs = []
     for run in new_runs:
-        # We are only interested in runs that have a log, i.e., not pending, action_required or similar runs
-        # Don't insert action_required runs else they will not be inserted later because DuplicateKeyError
-        if run["conclusion"] not in ["success", "failure", "timed_out"]:
+        if run["conclusion"] not in COMPLETED_CONCLUSIONS:
             LOGGER.debug("Run %d ignored because conclusion=%s", run["id"], run["conclusion"])
             continue
+        completed_runs.append(run)
+
+    # Runs that would be deleted by the worker are not inserted
+    retained_runs, discarded_runs = RETENTION_POLICY.select(completed_runs)
+    logger.info("%d runs discarded by retention policy", len(discarded_runs))
 
-        try:
+    with BulkWriter(MONGO_RUNS) as runs_writer:
+        for run in retained_runs:
             run_uid = f"{run['repository']['full_name']}_{run['path']}_{run['run_number']}_{run['run_attempt']}"
-            MONGO_RUNS.insert_one(
+            runs_writer.insert_one(
                 {
                     "_id": run_uid,
                     "repository_name": run["repository"]["full_name"],
@@ -103,15 +172,60 @@ def process_repo(repo) -> None:
                         datetime.now() - datetime.strptime(run["created_at"], "%Y-%m-%dT%H:%M:%SZ")
                     ).total_seconds(),
                     "metadata": run,
-                }
+                },
+                on_error=on_insert_error,
             )
-            inserted_runs_count += 1
-        except DuplicateKeyError:
-            logger.warning("%s already imported", run_uid)
-    logger.info("%d runs inserted into MongoDB", inserted_runs_count)
+    logger.info("%d runs inserted into MongoDB", runs_writer.counters["inserted"])
+    RUNS.inc(len(new_runs) - len(completed_runs), result="not_completed")
+    RUNS.inc(len(discarded_runs), result="discarded")
+    RUNS.inc(runs_writer.counters["inserted"], result="inserted")
+    REPOSITORIES.inc(result="success")
 
     if new_runs:
-        PIKA_WRAPPER.publish("repositories", {"repo_name": repo["_id"]})
+        with PUBLISH_LOCK:
+            pika_wrapper.publish("repositories", {"repo_name": repo["_id"]})
+
+    return "success"
+
+
+def fetch_repo(repo) -> str:
+    """
+    Process a repo, errors are logged (a failing repository does not stop the cycle)
+    Return result (not_modified, success or failure)
+    """
+    try:
+        with REPOSITORY_DURATION.time():
+            return process_repo(repo)
+    except Exception:
+        LOGGER.exception("Fail to process repo '%s'", repo["_id"])
+        ERRORS.inc(stage="repository")
+        REPOSITORIES.inc(result="failure")
+        return "failure"
+
+
+def run_cycle(repositories: List[Dict]) -> Dict[str, int]:
+    """
+    Process repositories, FETCHER_CONCURRENCY at a time
+    Return number of repositories by result
+    """
+    start_time = time.time()
+    results: Dict[str, int] = {}
+    with ThreadPoolExecutor(max_workers=FETCHER_CONCURRENCY, thread_name_prefix="fetcher") as executor:
+        for result in tqdm(executor.map(fetch_repo, repositories), total=len(repositories)):
+            results[result] = results.get(result, 0) + 1
+
+    duration = time.time() - start_time
+    CYCLES.inc()
+    CYCLE_DURATION.set(duration)
+    LOGGER.info(
+        "%d repositories processed in %0.1fs (%0.2f repositories/s): %s",
+        len(repositories),
+        duration,
+        len(repositories) / duration if duration else 0,
+        results,
+        extra={"duration_s": duration, "results": results},
+    )
+    return results
 
 
 def main():
@@ -121,18 +235,18 @@ def main():
     mongo_filter = {"selected": True}
 
     # Ensure RabbitMQ queue exists
-    PIKA_WRAPPER.channel.queue_declare(queue="repositories", durable=True)
+    pika_wrapper, _, _ = get_clients()
+    pika_wrapper.channel.queue_declare(queue="repositories", durable=True)
+
+    if METRICS_PORT is not None:
+        start_http_server(METRICS_PORT)
 
     while True:
         # Copy repositories to a list as MongoDB cursor can expire if scraping is long
         LOGGER.info("Fetching repositories from MongoDB...")
         repositories = list(MONGO_REPOSITORIES.find(mongo_filter, sort=[("_id", 1)]))
         assert repositories, "Query returned no result!"
-        for repo in tqdm(repositories):
-            try:
-                process_repo(repo)
-            except Exception:
-                LOGGER.exception("Fail to process repo '%s'", repo["_id"])
+        run_cycle(repositories)
 
 
 if __name__ == "__main__":
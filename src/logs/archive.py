@@ -0,0 +1,620 @@
+"""
+Log archives of runs
+
+Three formats are supported:
+- tar.gz: single gzip stream, reading one member requires to decompress all previous members
+- zlogs: members are compressed independently (raw deflate sharing a preset dictionary) and listed in an index,
+  so listing members and reading one member does not require to decompress other members
+- dedup: the archive is a manifest, members are stored in a content-addressed chunk store shared by all runs
+
+zlogs layout:
+    magic | member 1 | ... | member N | dictionary | index (zlib-compressed JSON) | footer
+
+dedup layout:
+    Job logs of consecutive runs (and reruns) are identical apart from the timestamp at the start of each line.
+    Timestamps are removed from lines and stored apart, then the remaining content is cut into chunks at line ends
+    chosen from the content of lines (content-defined chunking), so identical sections give identical chunks.
+    Chunks and timestamps are zlib-compressed objects of ChunkStore, stored once whatever the number of runs using them.
+    The archive is a manifest: magic | zlib-compressed JSON listing objects of each member
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import tarfile
+import tempfile
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
+
+MAGIC = b"GHALOGS1"
+# Index offset, index size, dictionary offset, dictionary size, magic
+FOOTER = struct.Struct("<QQQQ8s")
+
+# zlib only uses the last 32KB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+DEDUP_MAGIC = b"GHADEDUP1"
+# Directory of the chunk store of dedup archives
+CHUNK_STORE_DIR = os.environ.get("LOGS_CHUNK_STORE_DIR", os.path.join(os.environ.get("DATA_DIR", "data"), "chunks"))
+# Timestamp (with the UTF-8 BOM of the first line) and the following space at the start of job log lines
+LINE_TIMESTAMP = re.compile(rb"(?:\xef\xbb\xbf)?\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z ")
+# Lines are read up to this size (longer lines are read in several pieces)
+MAX_LINE_SIZE = 2**20
+# A chunk ends after a line whose checksum matches CHUNK_BOUNDARY_MASK (1 line out of 64 on average),
+# once the chunk is larger than MIN_CHUNK_SIZE, or when it reaches MAX_CHUNK_SIZE
+CHUNK_BOUNDARY_MASK = 0x3F
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# Size of objects storing timestamps
+TIMESTAMPS_OBJECT_SIZE = 2**20
+
+
+class LogArchiveError(ValueError):
+    """
+    Exception raised when a log archive is corrupted
+    """
+
+
+@dataclass
+class ArchiveMember:
+    """
+    Member of a zlogs archive (same attributes as tarfile.TarInfo for name, size and mtime)
+    """
+
+    name: str
+    size: int
+    mtime: float
+    offset: int = 0
+    compressed_size: int = 0
+
+
+class IndexedArchiveWriter:
+    """
+    Write a zlogs archive
+    The archive is written to a temporary file, renamed to path on close (discarded if the with block fails)
+    """
+
+    def __init__(self, path: str, dictionary: bytes = b"", level: int = 9) -> None:
+        """
+        dictionary: content shared by members (e.g., beginning of a job log), only the last 32KB are used
+        """
+        self.path = path
+        self.fd = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", prefix=".tmp-", delete=False)
+        self.dictionary = dictionary[-DICTIONARY_SIZE:]
+        self.level = level
+        self.members: List[ArchiveMember] = []
+        self.fd.write(MAGIC)
+
+    def add(self, name: str, fileobj: BinaryIO, size: int, mtime: float) -> None:
+        """
+        Compress fileobj content as a new member
+        """
+        member = ArchiveMember(name=name, size=0, mtime=mtime, offset=self.fd.tell())
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        while chunk := fileobj.read(CHUNK_SIZE):
+            member.size += len(chunk)
+            self.fd.write(compressor.compress(chunk))
+        self.fd.write(compressor.flush())
+        member.compressed_size = self.fd.tell() - member.offset
+        if member.size != size:
+            raise LogArchiveError(f"{name}: {member.size} bytes read, {size} expected")
+        self.members.append(member)
+
+    def close(self) -> None:
+        """
+        Write dictionary, index and footer
+        """
+        dictionary_offset = self.fd.tell()
+        self.fd.write(self.dictionary)
+
+        index_offset = self.fd.tell()
+        index = zlib.compress(
+            json.dumps(
+                [[member.name, member.size, member.mtime, member.offset, member.compressed_size] for member in self.members]
+            ).encode()
+        )
+        self.fd.write(index)
+
+        self.fd.write(FOOTER.pack(index_offset, len(index), dictionary_offset, len(self.dictionary), MAGIC))
+        self.fd.close()
+        os.replace(self.fd.name, self.path)
+
+    def discard(self) -> None:
+        """
+        Remove the archive being written (e.g., on failure: an archive without footer must not be left)
+        """
+        self.fd.close()
+        os.remove(self.fd.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class MemberReader(io.RawIOBase):
+    """
+    Decompress a member of a zlogs archive on read
+    """
+
+    def __init__(self, fd: BinaryIO, member: ArchiveMember, dictionary: bytes) -> None:
+        super().__init__()
+        self.fd = fd
+        self.position = member.offset
+        self.remaining = member.compressed_size
+        if dictionary:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            elif self.remaining:
+                # fd is shared by members: seek before each read
+                self.fd.seek(self.position)
+                data = self.fd.read(min(CHUNK_SIZE, self.remaining))
+                if not data:
+                    raise LogArchiveError("Unexpected end of archive")
+                self.position += len(data)
+                self.remaining -= len(data)
+            else:
+                self.pending = self.decompressor.flush()
+                if not self.pending:
+                    return 0
+                break
+            try:
+                self.pending = self.decompressor.decompress(data, len(buffer))
+            except zlib.error as err:
+                raise LogArchiveError(str(err)) from err
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class IndexedArchiveReader:
+    """
+    Read a zlogs archive (same methods as tarfile.TarFile for getmembers, getnames, getmember and extractfile)
+    """
+
+    def __init__(self, path: str) -> None:
+        self.fd = open(path, "rb")
+        try:
+            if self.fd.read(len(MAGIC)) != MAGIC:
+                raise LogArchiveError(f"{path} is not a zlogs archive")
+            self.fd.seek(-FOOTER.size, io.SEEK_END)
+            index_offset, index_size, dictionary_offset, dictionary_size, magic = FOOTER.unpack(self.fd.read(FOOTER.size))
+            if magic != MAGIC:
+                raise LogArchiveError(f"{path} is truncated")
+
+            self.fd.seek(dictionary_offset)
+            self.dictionary = self.fd.read(dictionary_size)
+
+            self.fd.seek(index_offset)
+            self.members: Dict[str, ArchiveMember] = {
+                name: ArchiveMember(name, size, mtime, offset, compressed_size)
+                for name, size, mtime, offset, compressed_size in json.loads(zlib.decompress(self.fd.read(index_size)))
+            }
+        except (OSError, struct.error, zlib.error, ValueError) as err:
+            self.fd.close()
+            if isinstance(err, LogArchiveError):
+                raise
+            raise LogArchiveError(f"Fail to read index of {path}: {err}") from err
+
+    def getmembers(self) -> List[ArchiveMember]:
+        """
+        Members in archive order
+        """
+        return list(self.members.values())
+
+    def getnames(self) -> List[str]:
+        """
+        Member names in archive order
+        """
+        return list(self.members)
+
+    def getmember(self, name: str) -> ArchiveMember:
+        """
+        Member by name
+        """
+        if name not in self.members:
+            raise KeyError(f"{name} not found")
+        return self.members[name]
+
+    def extractfile(self, member: Union[str, ArchiveMember]) -> io.BufferedReader:
+        """
+        File object to read a member
+        """
+        if isinstance(member, str):
+            member = self.getmember(member)
+        return io.BufferedReader(MemberReader(self.fd, member, self.dictionary), buffer_size=CHUNK_SIZE)
+
+    def close(self) -> None:
+        """
+        Close archive
+        """
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class TarGzArchiveWriter:
+    """
+    Write a tar.gz archive (same methods as IndexedArchiveWriter)
+    """
+
+    def __init__(self, path: str, dictionary: bytes = b"") -> None:  # pylint: disable=unused-argument
+        self.path = path
+        self.fd = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", prefix=".tmp-", delete=False)
+        self.tar_fd = tarfile.open(fileobj=self.fd, mode="w:gz")
+
+    def add(self, name: str, fileobj: BinaryIO, size: int, mtime: float) -> None:
+        """
+        Add fileobj content as a new member
+        """
+        tar_info = tarfile.TarInfo(name=name)
+        tar_info.size = size
+        tar_info.mtime = mtime
+        self.tar_fd.addfile(tarinfo=tar_info, fileobj=fileobj)
+
+    def close(self) -> None:
+        """
+        Close archive
+        """
+        self.tar_fd.close()
+        self.fd.close()
+        os.replace(self.fd.name, self.path)
+
+    def discard(self) -> None:
+        """
+        Remove the archive being written
+        """
+        self.tar_fd.close()
+        self.fd.close()
+        os.remove(self.fd.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class ChunkStore:
+    """
+    Content-addressed store of zlib-compressed objects: one file per object, named after the sha256 of its content
+    """
+
+    def __init__(self, root: str = CHUNK_STORE_DIR) -> None:
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        """
+        Path of an object
+        """
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data: bytes, level: int = 9) -> str:
+        """
+        Store data (if not already stored) and return its digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            os.utime(path)  # Objects recently used are not removed by collect_garbage
+            return digest
+        except FileNotFoundError:
+            pass  # Not stored, or removed by collect_garbage in the meantime
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Objects are renamed once written, as they can be written at the same time by several workers
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp-", delete=False) as fd:
+            fd.write(zlib.compress(data, level))
+        os.replace(fd.name, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """
+        Content of an object
+        """
+        try:
+            with open(self.path(digest), "rb") as fd:
+                return zlib.decompress(fd.read())
+        except (OSError, zlib.error) as err:
+            raise LogArchiveError(f"Fail to read object {digest}: {err}") from err
+
+    def digests(self) -> Iterator[str]:
+        """
+        Digests of stored objects
+        """
+        for _, _, files in os.walk(self.root):
+            for file in files:
+                if not file.startswith(".tmp-"):
+                    yield file
+
+    def collect_garbage(self, referenced_digests: set, min_age: float = 86400) -> Tuple[int, int]:
+        """
+        Remove objects that are not referenced and were not used for min_age seconds
+        (objects are written before the manifest referencing them)
+        Return number and size of removed objects
+        """
+        removed_objects, removed_size = 0, 0
+        for digest in list(self.digests()):
+            path = self.path(digest)
+            if digest in referenced_digests or time.time() - os.path.getmtime(path) < min_age:
+                continue
+            removed_size += os.path.getsize(path)
+            os.remove(path)
+            removed_objects += 1
+        return removed_objects, removed_size
+
+
+@dataclass
+class DedupMember:
+    """
+    Member of a dedup archive (same attributes as tarfile.TarInfo for name, size and mtime)
+    chunks and timestamps are lists of (digest, size) of objects
+    """
+
+    name: str
+    size: int
+    mtime: float
+    chunks: List[Tuple[str, int]] = field(default_factory=list)
+    timestamps: List[Tuple[str, int]] = field(default_factory=list)
+
+
+class DedupArchiveWriter:
+    """
+    Write a dedup archive (same methods as IndexedArchiveWriter)
+    """
+
+    def __init__(self, path: str, dictionary: bytes = b"", store: ChunkStore = None) -> None:  # pylint: disable=unused-argument
+        self.path = path
+        self.store = store or ChunkStore()
+        self.members: List[DedupMember] = []
+
+    def add(self, name: str, fileobj: BinaryIO, size: int, mtime: float) -> None:
+        """
+        Store fileobj content as a new member
+        """
+        member = DedupMember(name=name, size=0, mtime=mtime)
+        chunk = bytearray()
+        timestamps = bytearray()  # Timestamp of each line (empty if none) followed by a new line
+        line_start = True
+        while piece := fileobj.readline(MAX_LINE_SIZE):
+            member.size += len(piece)
+            if line_start:
+                match = LINE_TIMESTAMP.match(piece)
+                timestamp_end = match.end() if match and match.end() < len(piece) else 0
+                timestamps += piece[:timestamp_end]
+                timestamps += b"\n"
+                piece = piece[timestamp_end:]
+                if len(timestamps) >= TIMESTAMPS_OBJECT_SIZE:
+                    member.timestamps.append((self.store.put(bytes(timestamps)), len(timestamps)))
+                    timestamps.clear()
+            line_start = piece.endswith(b"\n")
+            chunk += piece
+
+            if len(chunk) >= MAX_CHUNK_SIZE \
+                    or (line_start and len(chunk) >= MIN_CHUNK_SIZE and zlib.crc32(piece) & CHUNK_BOUNDARY_MASK == 0):
+                member.chunks.append((self.store.put(bytes(chunk)), len(chunk)))
+                chunk.clear()
+        if chunk:
+            member.chunks.append((self.store.put(bytes(chunk)), len(chunk)))
+        if timestamps:
+            member.timestamps.append((self.store.put(bytes(timestamps)), len(timestamps)))
+
+        if member.size != size:
+            raise LogArchiveError(f"{name}: {member.size} bytes read, {size} expected")
+        self.members.append(member)
+
+    def close(self) -> None:
+        """
+        Write manifest
+        """
+        manifest = zlib.compress(
+            json.dumps(
+                [[member.name, member.size, member.mtime, member.chunks, member.timestamps] for member in self.members]
+            ).encode()
+        )
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path) or ".", prefix=".tmp-", delete=False) as fd:
+            fd.write(DEDUP_MAGIC + manifest)
+        os.replace(fd.name, self.path)
+
+    def discard(self) -> None:
+        """
+        Do not write the manifest (objects already stored are removed by ChunkStore.collect_garbage)
+        """
+        self.members.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class IteratorReader(io.RawIOBase):
+    """
+    Read bytes yielded by an iterator
+    """
+
+    def __init__(self, iterator: Iterator[bytes]) -> None:
+        super().__init__()
+        self.iterator = iterator
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            self.pending = next(self.iterator, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class DedupArchiveReader:
+    """
+    Read a dedup archive (same methods as IndexedArchiveReader)
+    """
+
+    def __init__(self, path: str, store: ChunkStore = None) -> None:
+        self.store = store or ChunkStore()
+        try:
+            with open(path, "rb") as fd:
+                if fd.read(len(DEDUP_MAGIC)) != DEDUP_MAGIC:
+                    raise LogArchiveError(f"{path} is not a dedup archive")
+                self.members: Dict[str, DedupMember] = {
+                    name: DedupMember(name, size, mtime, [tuple(obj) for obj in chunks], [tuple(obj) for obj in timestamps])
+                    for name, size, mtime, chunks, timestamps in json.loads(zlib.decompress(fd.read()))
+                }
+        except (OSError, zlib.error, ValueError) as err:
+            if isinstance(err, LogArchiveError):
+                raise
+            raise LogArchiveError(f"Fail to read manifest of {path}: {err}") from err
+
+    def getmembers(self) -> List[DedupMember]:
+        """
+        Members in archive order
+        """
+        return list(self.members.values())
+
+    def getnames(self) -> List[str]:
+        """
+        Member names in archive order
+        """
+        return list(self.members)
+
+    def getmember(self, name: str) -> DedupMember:
+        """
+        Member by name
+        """
+        if name not in self.members:
+            raise KeyError(f"{name} not found")
+        return self.members[name]
+
+    def iter_timestamps(self, member: DedupMember) -> Iterator[bytes]:
+        """
+        Timestamp of each line of a member (empty if the line has no timestamp)
+        """
+        for digest, _ in member.timestamps:
+            yield from self.store.get(digest).split(b"\n")[:-1]
+
+    def iter_content(self, member: DedupMember) -> Iterator[bytes]:
+        """
+        Content of a member (timestamps are put back at the start of lines)
+        """
+        timestamps = self.iter_timestamps(member)
+        line_start = True
+        for digest, _ in member.chunks:
+            chunk = self.store.get(digest)
+            pieces = []
+            start = 0
+            while start < len(chunk):
+                if line_start:
+                    pieces.append(next(timestamps, b""))
+                end = chunk.find(b"\n", start) + 1 or len(chunk)
+                pieces.append(chunk[start:end])
+                line_start = chunk[end - 1:end] == b"\n"
+                start = end
+            yield b"".join(pieces)
+
+    def extractfile(self, member: Union[str, DedupMember]) -> io.BufferedReader:
+        """
+        File object to read a member
+        """
+        if isinstance(member, str):
+            member = self.getmember(member)
+        return io.BufferedReader(IteratorReader(self.iter_content(member)), buffer_size=CHUNK_SIZE)
+
+    def close(self) -> None:
+        """
+        Close archive (the manifest is read on open)
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+ARCHIVE_WRITERS = {
+    "tar.gz": TarGzArchiveWriter,
+    "zlogs": IndexedArchiveWriter,
+    "dedup": DedupArchiveWriter,
+}
+
+
+def archive_format(path: str) -> str:
+    """
+    Archive format from path extension
+    """
+    for extension in ARCHIVE_WRITERS:
+        if path.endswith(f".{extension}"):
+            return extension
+    raise ValueError(f"Unknown archive format: {path}")
+
+
+def open_archive_writer(path: str, dictionary: bytes = b""):
+    """
+    Open a writer for the archive format of path
+    """
+    return ARCHIVE_WRITERS[archive_format(path)](path, dictionary=dictionary)
+
+
+def open_archive(path: str):
+    """
+    Open archive for reading (tarfile.TarFile, IndexedArchiveReader or DedupArchiveReader depending on path)
+    """
+    if archive_format(path) == "zlogs":
+        return IndexedArchiveReader(path)
+    if archive_format(path) == "dedup":
+        return DedupArchiveReader(path)
+    return tarfile.open(path, "r:gz")
+
+
+def convert_archive(path: str, output_path: str) -> None:
+    """
+    Write members of an archive to an archive of another format (e.g., rebuild the tar.gz archive of a dedup archive)
+    """
+    with open_archive(path) as archive_fd, open_archive_writer(output_path) as output_fd:
+        for member in archive_fd.getmembers():
+            member_fd = archive_fd.extractfile(member) or io.BytesIO()  # tarfile returns None for directories
+            output_fd.add(member.name, member_fd, size=member.size, mtime=member.mtime)
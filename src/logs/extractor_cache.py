@@ -0,0 +1,138 @@
+"""
+Content-addressed cache for bash-command-extractor results
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+
+from pymongo.errors import PyMongoError
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ExtractorCache:
+    """
+    Cache of bash-command-extractor results, keyed by a hash of the shell code and of the extractor version
+    - in-process LRU (thread-safe as API calls run in a thread pool)
+    - optional persistent tier shared by all workers (MongoDB collection)
+    """
+
+    def __init__(self, version: str, max_size: int = 10000, collection=None) -> None:
+        """
+        version: extractor version, a new version invalidates all cached results
+        collection: MongoDB collection used as persistent tier (None to disable it)
+        """
+        self.version = version
+        self.max_size = max_size
+        self.collection = collection
+
+        self.entries: "OrderedDict[str, Dict[str, any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0}
+
+    def key(self, code: str) -> str:
+        """
+        Cache key of shell code
+        """
+        return hashlib.sha256(f"{self.version}\0{code}".encode()).hexdigest()
+
+    def get(self, code: str) -> Optional[Dict[str, any]]:
+        """
+        Return cached result for shell code, None on cache miss
+        """
+        key = self.key(code)
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return result
+
+        if self.collection is not None:
+            try:
+                document = self.collection.find_one({"_id": key}, projection={"result": True})
+            except PyMongoError as err:
+                LOGGER.warning("Fail to read extractor cache: %s", err)
+                document = None
+            if document:
+                self._remember(key, document["result"])
+                with self.lock:
+                    self.counters["persistent_hits"] += 1
+                return document["result"]
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def set(self, code: str, result: Dict[str, any]) -> None:
+        """
+        Store result for shell code in all tiers
+        """
+        key = self.key(code)
+        self._remember(key, result)
+
+        if self.collection is not None:
+            try:
+                self.collection.update_one(
+                    {"_id": key},
+                    {
+                        "$setOnInsert": {
+                            "result": result,
+                            "extractor_version": self.version,
+                            "created_at": datetime.utcnow(),
+                        }
+                    },
+                    upsert=True,
+                )
+            except PyMongoError as err:
+                LOGGER.warning("Fail to write extractor cache: %s", err)
+
+    def warm(self, limit: Optional[int] = None) -> int:
+        """
+        Load the most recent results of the persistent tier in the in-process LRU (e.g., before forking workers)
+        Return the number of loaded results
+        """
+        if self.collection is None:
+            return 0
+        limit = min(limit or self.max_size, self.max_size)
+        try:
+            documents = list(
+                self.collection.find(
+                    {"extractor_version": self.version},
+                    projection={"result": True},
+                    sort=[("created_at", -1)],
+                    limit=limit,
+                )
+            )
+        except PyMongoError as err:
+            LOGGER.warning("Fail to load extractor cache: %s", err)
+            return 0
+        for document in reversed(documents):  # Most recent results are evicted last
+            self._remember(document["_id"], document["result"])
+        return len(documents)
+
+    def _remember(self, key: str, result: Dict[str, any]) -> None:
+        """
+        Store result in the in-process LRU
+        """
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, any]:
+        """
+        Hit/miss counters and hit ratio
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["memory_hits"] + stats["persistent_hits"]) / lookups if lookups else 0.0
+        return stats
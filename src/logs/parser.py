@@ -2,25 +2,79 @@
 This module provides log parsing capabilities
 """
 
+import codecs
+import io
 import json
 import logging
 import os
 import re
 import time
 import random
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from src.logs.extractor_cache import ExtractorCache
+from src.tools.metrics import Counter, Histogram
 
 LOGGER = logging.getLogger(__name__)
 
+# Version of the log parser
+# Bump it when insights returned by parse_log change, so stored results are reparsed (see misc/reprocess_stale_runs.py)
+PARSER_VERSION = "1"
+
 # API URL
 BASH_PARSER_API_URL = os.environ.get("BASH_PARSER_API_URL", "http://bash-command-extractor-api")
 
+# Version of @tdurieux/bash-command-extractor behind the API (see bash-command-extractor-api/Dockerfile)
+# Cached results are tied to this version
+BASH_PARSER_VERSION = os.environ.get("BASH_PARSER_VERSION", "0.2.3")
+
+# Stamped on parsed jobs and runs: results stamped with other versions are stale
+PARSING_VERSIONS = {"parser_version": PARSER_VERSION, "extractor_version": BASH_PARSER_VERSION}
+
+# Maximum number of concurrent calls to the API
+BASH_PARSER_MAX_WORKERS = int(os.environ.get("BASH_PARSER_MAX_WORKERS", "8"))
+
+
+def new_session() -> requests.Session:
+    """
+    Session for the API (connection pool sized for concurrent calls)
+    """
+    session = requests.Session()
+    session.headers.update({"Content-Type": "text/plain"})
+    session.mount("http://", HTTPAdapter(pool_maxsize=BASH_PARSER_MAX_WORKERS))
+    session.mount("https://", HTTPAdapter(pool_maxsize=BASH_PARSER_MAX_WORKERS))
+    return session
+
+
 # Session
-SESSION = requests.Session()
-SESSION.headers.update({"Content-Type": "text/plain"})
+SESSION = new_session()
+
+# Cache of API results (in-process only, workers set EXTRACTOR_CACHE.collection to share results)
+EXTRACTOR_CACHE = ExtractorCache(
+    BASH_PARSER_VERSION,
+    max_size=int(os.environ.get("BASH_PARSER_CACHE_SIZE", "10000")),
+)
+
+# Metrics
+EXTRACTOR_DURATION = Histogram(
+    "gha_extractor_request_duration_seconds",
+    "Duration of bash-command-extractor API calls (including retries)",
+    ["result"],
+)
+EXTRACTOR_CACHE_LOOKUPS = Counter(
+    "gha_extractor_cache_lookups_total",
+    "Lookups in the cache of bash-command-extractor results",
+    ["result"],
+    function=lambda: {
+        (result,): EXTRACTOR_CACHE.stats()[key]
+        for result, key in [("memory_hit", "memory_hits"), ("persistent_hit", "persistent_hits"), ("miss", "misses")]
+    },
+)
 
 # Action metadata parsing
 ACTIONS_DOWNLOAD = re.compile(r"^.{28} Download action repository '(?P<repo>[^/]+)/(?P<name>[^@]+)@(?P<version>[^']+)' \(SHA:(?P<sha>\w+)\)$", re.MULTILINE)
@@ -31,10 +85,22 @@ ACTION_REF = re.compile(r'^(?P<repo>[^/]+)/(?P<name>[^/@]+)/?(?P<folder>[^@]+)?@
 # This regular expression can extract unexpected lines (lines other than those indicating the permissions of the Github token).
 # Let's see if this is the case before making the expression more complex...
 TOKEN_PERMISSIONS = re.compile(r"^.{28} (?P<scope>\w+): (?P<permission>write|read)$", re.MULTILINE)
-IMAGE_VERSION = re.compile(r"Runner Image\n.{28} Image: (?P<image>[\w.-]+)\n.{28} Version: (?P<version>[\w.-]+)\n")
+RUNNER_IMAGE_HEADER = "Runner Image"
+IMAGE_NAME = re.compile(r"^.{28} Image: (?P<image>[\w.-]+)$")
+IMAGE_VERSION = re.compile(r"^.{28} Version: (?P<version>[\w.-]+)$")
 
 # Step parsing
-LOG_GROUPS_PATTERN = re.compile(r'(?P<start>.{28}) ##\[group\]Run (?P<target>[^\n]+)(.*?)\n.{28} ##\[endgroup\]', re.DOTALL)
+# Every log line starts with a 28-char timestamp (e.g., "2023-09-21T17:21:42.0537385Z") followed by a space
+TIMESTAMP_LENGTH = 28
+GROUP_RUN_MARKER = " ##[group]Run "
+ENDGROUP_MARKER = " ##[endgroup]"
+
+# Memory bounds, so logs of any size can be parsed
+# Lines longer than MAX_LINE_SIZE bytes are read in pieces (e.g., minified files or progress bars printed to logs),
+# pieces of a line are joined up to MAX_GROUP_BODY_SIZE chars (see join_line_pieces)
+MAX_LINE_SIZE = 2**20
+# Body of a "Run" group is truncated beyond MAX_GROUP_BODY_SIZE chars (e.g., group closed thousands of lines later)
+MAX_GROUP_BODY_SIZE = 10 * 2**20
 
 # Action parameters parsing
 WITH_BLOCK_PATTERN = re.compile(r'with:\n(.+?)(?:\n.{28} \w|$)', re.DOTALL)
@@ -45,25 +111,6 @@ ACTION_PARAMETERS_KEY_VALUE = re.compile(r'\s{3}(?P<key>.*):\s(?P<value>.*)')
 SHELL_COMMANDS_PATTERN = re.compile(r'.{28} \[36;1m(?P<command>.*?)\[0m$', re.MULTILINE)
 
 
-def parse_context(log: str) -> Dict[str, any]:
-    """
-    Extract actions used, token permissions and runner image from the log
-    """
-    info = {}
-
-    token_permissions = TOKEN_PERMISSIONS.findall(log)
-    if token_permissions:
-        info["token_permissions"] = {}
-        for token_permission in token_permissions:
-            info["token_permissions"][token_permission[0]] = token_permission[1]
-
-    image_version = IMAGE_VERSION.search(log)
-    if image_version:
-        info["image"], info["image_version"] = image_version.groups()
-
-    return info
-
-
 def parse_action_parameters(body: str) -> Dict[str, any]:
     """
     Extract dict of with: parameters
@@ -86,9 +133,10 @@ def parse_action_parameters(body: str) -> Dict[str, any]:
     }
 
 
-def parse_shell_parameters(body: str) -> Dict[str, any]:
+def parse_shell_parameters(body: str, extract_commands: bool = True) -> Dict[str, any]:
     """
     Extract dict of shell parameters
+    extract_commands: call bash-command-extractor API on the code (else, only env and code are returned)
     """
     shell_parameters = {
         "env": {},
@@ -102,7 +150,8 @@ def parse_shell_parameters(body: str) -> Dict[str, any]:
     shell_commands = SHELL_COMMANDS_PATTERN.findall(body)
     if shell_commands:
         shell_parameters["code"] = "\n".join(shell_commands)
-        shell_parameters.update(run_bash_command_extractor(shell_parameters["code"]))
+        if extract_commands:
+            shell_parameters.update(run_bash_command_extractor(shell_parameters["code"]))
     else:
         LOGGER.warning("No shell command found in: %s", body)
 
@@ -110,6 +159,32 @@ def parse_shell_parameters(body: str) -> Dict[str, any]:
 
 
 def run_bash_command_extractor(code: str, max_attempts: int = 3) -> Dict[str, any]:
+    """
+    Get commands extracted from shell code, from EXTRACTOR_CACHE or from bash-command-extractor API
+    Only results that do not depend on API availability are cached (success or invalid shell code)
+    """
+    result = EXTRACTOR_CACHE.get(code)
+    if result is not None:
+        LOGGER.debug("Shell code found in cache")
+        return result
+
+    start_time = time.perf_counter()
+    result = call_bash_command_extractor(code, max_attempts=max_attempts)
+    EXTRACTOR_DURATION.observe(time.perf_counter() - start_time, result="error" if "error" in result else "success")
+    if is_deterministic_result(result):
+        EXTRACTOR_CACHE.set(code, result)
+    return result
+
+
+def is_deterministic_result(result: Dict[str, any]) -> bool:
+    """
+    True if a result of bash-command-extractor (or a step including it) does not depend on API availability
+    (success or invalid shell code)
+    """
+    return "error" not in result or result["error"].get("error") == "Invalid shell code"
+
+
+def call_bash_command_extractor(code: str, max_attempts: int = 3) -> Dict[str, any]:
     """
     Call bash-command-extractor API
     """
@@ -143,44 +218,150 @@ def run_bash_command_extractor(code: str, max_attempts: int = 3) -> Dict[str, an
         time.sleep(random.random() * 2**i)
 
 
-def parse_log(log: str) -> Dict[str, any]:
+def join_line_pieces(lines: Iterable[str]) -> Iterator[Tuple[str, int, bool]]:
     """
-    Parse log and return insights extracted from the log
+    Text (without trailing "\n"), size (without trailing "\n") and end of line ("\n" found) of each line
+    Lines can be in pieces (only the last piece ends with "\n", see read_log_lines): pieces are joined, and a line
+    longer than MAX_GROUP_BODY_SIZE chars is truncated (the body of a group is truncated anyway)
     """
+    pieces = []  # Pieces of the line being read
+    size = 0  # Size of the line being read, including truncated pieces
+    kept_size = 0  # Size of the kept pieces
+    for line in lines:
+        ended = line.endswith("\n")
+        if ended and not pieces:
+            yield line[:-1], len(line) - 1, True
+            continue
+        piece = line[:-1] if ended else line
+        size += len(piece)
+        if kept_size < MAX_GROUP_BODY_SIZE:
+            pieces.append(piece[:MAX_GROUP_BODY_SIZE - kept_size])
+            kept_size += len(pieces[-1])
+        if ended:
+            yield "".join(pieces), size, True
+            pieces, size, kept_size = [], 0, 0
+    if size:
+        yield "".join(pieces), size, False
+
+
+def parse_log_lines(lines: Iterable[str], executor: Optional[Executor] = None) -> Dict[str, any]:
+    """
+    Parse log lines (including their trailing "\n") in a single pass and return insights extracted from the log
+    Lines can be in pieces (e.g., lines longer than MAX_LINE_SIZE from read_log_lines), markers are only matched at
+    the start of lines
+    Lines are processed by a state machine over the timestamp prefix and the ##[group]Run/##[endgroup] markers,
+    so the whole log never has to be held in memory
+
+    Shell code of each step is sent to bash-command-extractor API through executor as soon as the step is read,
+    so API calls run concurrently with each other and with the parsing of the rest of the log.
+    If executor is not provided, a pool of BASH_PARSER_MAX_WORKERS threads is used for this log only.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=BASH_PARSER_MAX_WORKERS) as log_executor:
+            return parse_log_lines(lines, executor=log_executor)
 
-    info = {}
-
-    info.update(
-        {
-            "total_lines": log.count("\n"),
-            "log_size": len(log),
-        }
-    )
+    total_lines = 0
+    log_size = 0
+    last_line = None
 
-    info.update(parse_context(log))
+    token_permissions = {}
+    image_version = None
+    after_runner_image = False  # Previous line ended with "Runner Image"
+    image = None  # Image found on the line following "Runner Image", version is expected on the next line
 
-    # Extract list of actions from "Download action repository" lines
     actions = {}
-    for action in ACTIONS_DOWNLOAD.findall(log):
-        actions[f"{action[0]}/{action[1]}@{action[2]}"] = (
-            {
-                "repository": action[0],
-                "action": action[1],
-                "version": action[2],
-                "sha": action[3],
-            }
-        )
+
+    groups = []  # (start_date_str, target, target_action, parameters, extraction) of each "Run" group
+    group_body_size = 0
+    extractions: Dict[str, Future] = {}  # Calls to bash-command-extractor API by shell code (identical code is sent once)
+    group = None  # (start_date_str, target, body_lines) of the group being read
+    group_run_offset = TIMESTAMP_LENGTH + len(GROUP_RUN_MARKER)
+
+    for text, size, ended in join_line_pieces(lines):
+        log_size += size + ended
+        if ended:
+            total_lines += 1
+        last_line = text
+
+        # Runner image: "Runner Image", "Image: <image>" and "Version: <version>" on 3 consecutive lines
+        if image_version is None:
+            if image is not None:
+                version = IMAGE_VERSION.match(text)
+                if version and ended:
+                    image_version = (image, version.group("version"))
+                image = None
+            elif after_runner_image:
+                image_match = IMAGE_NAME.match(text)
+                if image_match:
+                    image = image_match.group("image")
+            after_runner_image = text.endswith(RUNNER_IMAGE_HEADER)
+
+        if text.endswith(("read", "write")):
+            token_permission = TOKEN_PERMISSIONS.match(text)
+            if token_permission:
+                token_permissions[token_permission.group("scope")] = token_permission.group("permission")
+
+        # Extract list of actions from "Download action repository" lines
+        if text.startswith("Download action repository '", TIMESTAMP_LENGTH + 1):
+            action = ACTIONS_DOWNLOAD.match(text)
+            if action:
+                actions[f"{action.group('repo')}/{action.group('name')}@{action.group('version')}"] = {
+                    "repository": action.group("repo"),
+                    "action": action.group("name"),
+                    "version": action.group("version"),
+                    "sha": action.group("sha"),
+                }
+
+        # Steps: "Run" groups, nested groups are part of the body of the enclosing group
+        if group is None:
+            if text.startswith(GROUP_RUN_MARKER, TIMESTAMP_LENGTH) and len(text) > group_run_offset:
+                group = (text[:TIMESTAMP_LENGTH], text[group_run_offset:], [])
+                group_body_size = 0
+        elif text.startswith(ENDGROUP_MARKER, TIMESTAMP_LENGTH):
+            start_date_str, target, body_lines = group
+            body = "".join(f"\n{body_line}" for body_line in body_lines)
+            LOGGER.debug("Processing step 'Run %s'\nbody: %s", target, body)
+
+            # For actions, run can be "Run github/codeql-action/autobuild@v2"
+            # But in actions dict, it will be "github/codeql-action@v2" (as extraction from 'Download action repository' log messages)
+            target_action = ACTION_REF.search(target)
+            extraction = None
+            if target_action:
+                parameters = parse_action_parameters(body)
+            else:
+                parameters = parse_shell_parameters(body, extract_commands=False)
+                if parameters["code"]:
+                    extraction = extractions.get(parameters["code"])
+                    if extraction is None:
+                        extraction = executor.submit(run_bash_command_extractor, parameters["code"])
+                        extractions[parameters["code"]] = extraction
+            groups.append((start_date_str, target, target_action, parameters, extraction))
+            group = None
+        elif group_body_size <= MAX_GROUP_BODY_SIZE:
+            group_body_size += size + ended
+            if group_body_size > MAX_GROUP_BODY_SIZE:
+                LOGGER.warning("Body of step 'Run %s' is larger than %d chars: truncated", group[1], MAX_GROUP_BODY_SIZE)
+            else:
+                group[2].append(text)
+
+    info = {
+        "total_lines": total_lines,
+        "log_size": log_size,
+    }
+
+    if token_permissions:
+        info["token_permissions"] = token_permissions
+
+    if image_version:
+        info["image"], info["image_version"] = image_version
+
     LOGGER.debug("actions: %s", actions)
 
-    # Loop on matched groups
+    # Steps are built once the whole log is read as "Download action repository" lines are needed to describe actions
     steps = []
-    for start_date_str, target, body in LOG_GROUPS_PATTERN.findall(log):
-        LOGGER.debug("Processing step 'Run %s'\nbody: %s", target, body)
+    for start_date_str, target, target_action, parameters, extraction in groups:
         step_info = {}
 
-        # For actions, run can be "Run github/codeql-action/autobuild@v2"
-        # But in actions dict, it will be "github/codeql-action@v2" (as extraction from 'Download action repository' log messages)
-        target_action = ACTION_REF.search(target)
         if target_action:
             step_info["type"] = "action"
             action_info = actions.get(f"{target_action.group('repo')}/{target_action.group('name')}@{target_action.group('version')}")
@@ -198,10 +379,9 @@ def parse_log(log: str) -> Dict[str, any]:
         else:
             step_info["type"] = "shell"
 
-        if step_info["type"] == "action":
-            step_info.update(parse_action_parameters(body))
-        else:
-            step_info.update(parse_shell_parameters(body))
+        step_info.update(parameters)
+        if extraction is not None:
+            step_info.update(extraction.result())
 
         step_info["start_date"] = datetime.strptime(start_date_str[:-2], "%Y-%m-%dT%H:%M:%S.%f")
         if steps:
@@ -213,17 +393,80 @@ def parse_log(log: str) -> Dict[str, any]:
 
     # Find the duration of the last step (if there is at least 1 step)
     if steps:
-        final_line_date = datetime.strptime(log.splitlines()[-1][:26], "%Y-%m-%dT%H:%M:%S.%f")
         try:
+            final_line_date = datetime.strptime(last_line[:26], "%Y-%m-%dT%H:%M:%S.%f")
             steps[-1]["duration_sec"] = (final_line_date - steps[-1]["start_date"]).total_seconds()
         except ValueError:
-            LOGGER.warning("Fail to compute duration_sec for last step because parsing of final line failed: '%s'", final_line_date)
+            LOGGER.warning("Fail to compute duration_sec for last step because parsing of final line failed: '%s'", last_line)
 
     info["steps"] = steps
 
     return info
 
 
+def read_log_lines(fd: BinaryIO) -> Iterator[str]:
+    """
+    Read and decode lines of a log from a binary file object
+    Lines longer than MAX_LINE_SIZE bytes are returned in pieces (only the last piece ends with "\n")
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()  # A piece can end in the middle of a character
+    in_line = False  # Previous piece did not end with "\n"
+    while line := fd.readline(MAX_LINE_SIZE):
+        if in_line or not line.endswith(b"\n"):
+            yield decoder.decode(line)
+            in_line = not line.endswith(b"\n")
+        else:
+            yield line.decode("utf-8")
+    remaining = decoder.decode(b"", final=True)
+    if remaining:
+        yield remaining
+
+
+def parse_log_file(fd: BinaryIO, executor: Optional[Executor] = None) -> Dict[str, any]:
+    """
+    Parse log from a binary file object (e.g., tar member from extractfile) without reading it at once
+    Memory usage does not depend on the size of the log
+    """
+    return parse_log_lines(read_log_lines(fd), executor=executor)
+
+
+def parse_log_path(path: str, remove: bool = False) -> Dict[str, any]:
+    """
+    Parse log stored in a file (e.g., from a process pool, as file objects cannot be sent to another process)
+    remove: delete the file once parsed
+    """
+    start_time = time.time()
+    try:
+        with open(path, "rb") as fd:
+            parsing_results = parse_log_file(fd)
+    finally:
+        if remove:
+            os.remove(path)
+    parsing_duration_ms = (time.time() - start_time) * 1000
+    LOGGER.info(
+        "Log parsed in %dms",
+        parsing_duration_ms,
+        extra={"duration_ms": parsing_duration_ms}
+    )
+    return parsing_results
+
+
+def reset_session() -> None:
+    """
+    Use a new session for the API (e.g., in a forked process, as connections of the parent process must not be shared)
+    """
+    global SESSION  # pylint: disable=global-statement
+    SESSION = new_session()
+
+
+def parse_log(log: str, executor: Optional[Executor] = None) -> Dict[str, any]:
+    """
+    Parse log and return insights extracted from the log
+    """
+    # newline="\n": split on "\n" only (a "\r" is part of the line)
+    return parse_log_lines(io.StringIO(log, newline="\n"), executor=executor)
+
+
 if __name__ == "__main__":
     import hashlib
     import os
@@ -244,6 +487,5 @@ if __name__ == "__main__":
             if "/" in zip_info.filename:  # Only job logs
                 continue
             with zip_fd.open(zip_info.filename) as f:
-                _log = f.read().decode()
-                print(json.dumps(parse_log(_log), indent=4, default=str))
+                print(json.dumps(parse_log_file(f), indent=4, default=str))
                 print("***")
@@ -0,0 +1,240 @@
+"""
+Metrics in Prometheus text format, served over HTTP (stdlib only)
+
+Metrics are registered in REGISTRY when they are created, and served by start_http_server (e.g., if METRICS_PORT is set)
+Metrics are per process: processes of a pool (e.g., parse pool of the worker) do not report to the main process
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# Latency buckets (in seconds), from 5ms to 10min
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    """
+    Labels in Prometheus text format (e.g., {stage="download"})
+    """
+    labels = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    """
+    Metric with optional labels (values by tuple of label values)
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        """
+        function: called on each scrape, returns values by tuple of label values (instead of values set in this process)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        Tuple of label values
+        """
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        """
+        Lines of the metric in Prometheus text format
+        """
+        if self.function is not None:
+            values = self.function()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Counter(Metric):
+    """
+    Value that only increases
+    """
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increase counter
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can increase and decrease
+    """
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Set gauge
+        """
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increase gauge
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """
+        Decrease gauge
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (e.g., durations in seconds)
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(name, documentation, labelnames, **kwargs)
+        self.buckets = tuple(buckets)
+        # Count by bucket, sum and count of observed values, by tuple of label values
+        self.observations: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Observe a value
+        """
+        key = self.key(labels)
+        with self.lock:
+            bucket_counts, total, count = self.observations.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    bucket_counts[i] += 1
+                    break
+            self.observations[key] = (bucket_counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of a block of code
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            observations = {key: (list(bucket_counts), total, count) for key, (bucket_counts, total, count) in self.observations.items()}
+        lines = []
+        for key, (bucket_counts, total, count) in observations.items():
+            cumulative_count = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative_count += bucket_count
+                bucket_labels = format_labels(self.labelnames, key, f'le="{bucket}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative_count}")
+            bucket_labels = format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Set of metrics served together
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        """
+        Add a metric
+        """
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+
+    def exposition(self) -> str:
+        """
+        All metrics in Prometheus text format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                LOGGER.exception("Fail to collect metric %s", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve metrics of registry on GET
+    """
+
+    registry: Registry = REGISTRY
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Metrics in Prometheus text format
+        """
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug(format, *args)
+
+
+def start_http_server(port: int, host: str = "0.0.0.0", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serve metrics in a background thread
+    """
+    handler = type("RegistryMetricsHandler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    LOGGER.info("Metrics served on http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,136 @@
+"""
+Batching of MongoDB writes
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.tools.metrics import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+MONGO_DURATION = Histogram("gha_mongo_duration_seconds", "Duration of MongoDB operations", ["operation"])
+
+
+class BulkWriter:
+    """
+    Buffer write operations on a collection and send them with a single unordered bulk_write
+    Operations are sent when max_size operations are buffered, when the oldest buffered operation is older than
+    max_delay seconds (checked when an operation is added), on flush() and when leaving the context manager
+    """
+
+    def __init__(self, collection, max_size: int = 1000, max_delay: float = 5) -> None:
+        self.collection = collection
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.operations: List[Any] = []
+        # Called with the write error (dict with code, errmsg and op) if the operation at the same index fails
+        self.error_handlers: List[Optional[Callable[[Dict[str, Any]], None]]] = []
+        self.first_operation_time = 0.0
+        self.lock = threading.Lock()
+
+        self.counters = {"inserted": 0, "upserted": 0, "matched": 0, "modified": 0, "deleted": 0, "errors": 0}
+        self.write_time = 0.0  # Total duration of bulk writes (in seconds)
+
+    def add(self, operation, on_error: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        Buffer a pymongo operation (InsertOne, UpdateOne, DeleteOne...)
+        on_error: called with the write error if the operation fails (else the error is logged)
+        """
+        with self.lock:
+            if not self.operations:
+                self.first_operation_time = time.time()
+            self.operations.append(operation)
+            self.error_handlers.append(on_error)
+            flush = len(self.operations) >= self.max_size or time.time() - self.first_operation_time >= self.max_delay
+        if flush:
+            self.flush()
+
+    def insert_one(self, document: Dict[str, Any], on_error: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        Buffer an insert
+        """
+        self.add(InsertOne(document), on_error=on_error)
+
+    def update_one(
+        self,
+        query: Dict[str, Any],
+        update: Dict[str, Any],
+        upsert: bool = False,
+        on_error: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        """
+        Buffer an update
+        """
+        self.add(UpdateOne(query, update, upsert=upsert), on_error=on_error)
+
+    def delete_one(self, query: Dict[str, Any], on_error: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        Buffer a delete
+        """
+        self.add(DeleteOne(query), on_error=on_error)
+
+    def delete_many(self, query: Dict[str, Any], on_error: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        Buffer a delete of all matching documents
+        """
+        self.add(DeleteMany(query), on_error=on_error)
+
+    def flush(self) -> Dict[str, int]:
+        """
+        Send buffered operations (unordered: a failing operation does not prevent the others)
+        Return counters of this bulk write
+        Other exceptions than write errors (e.g., connection errors) are raised, buffered operations are then lost
+        """
+        with self.lock:
+            operations, error_handlers = self.operations, self.error_handlers
+            self.operations, self.error_handlers = [], []
+        if not operations:
+            return {}
+
+        start_time = time.perf_counter()
+        try:
+            with MONGO_DURATION.time(operation="bulk_write"):
+                result = self.collection.bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as err:
+            result = err.details
+        finally:
+            with self.lock:
+                self.write_time += time.perf_counter() - start_time
+
+        for write_error in result.get("writeErrors", []):
+            error_handler = error_handlers[write_error["index"]]
+            if error_handler is not None:
+                error_handler(write_error)
+            else:
+                LOGGER.warning("Fail to write %s: %s", write_error["op"], write_error["errmsg"])
+        for write_concern_error in result.get("writeConcernErrors", []):
+            LOGGER.warning("Write concern error: %s", write_concern_error["errmsg"])
+
+        counters = {
+            "inserted": result.get("nInserted", 0),
+            "upserted": result.get("nUpserted", 0),
+            "matched": result.get("nMatched", 0),
+            "modified": result.get("nModified", 0),
+            "deleted": result.get("nRemoved", 0),
+            "errors": len(result.get("writeErrors", [])),
+        }
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+        LOGGER.debug("%d operations written: %s", len(operations), counters)
+        return counters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.flush()
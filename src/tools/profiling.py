@@ -0,0 +1,155 @@
+"""
+Timing of processing stages, and profiling of the slowest tasks
+"""
+
+import cProfile
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StageStats:
+    """
+    Wall and CPU time by stage, and counters (e.g., bytes)
+    CPU time is the CPU time of the thread running the stage (time waiting for other threads is not counted)
+    """
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, List[float]] = {}  # [wall, cpu] by stage
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, wall: float, cpu: float = 0.0) -> None:
+        """
+        Add time to a stage
+        """
+        with self.lock:
+            times = self.stages.setdefault(stage, [0.0, 0.0])
+            times[0] += wall
+            times[1] += cpu
+
+    def count(self, counter: str, value: int) -> None:
+        """
+        Add value to a counter
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def measure(self, stage: str):
+        """
+        Add time of a block of code to a stage
+        """
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+
+    def wrap(self, stage: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        """
+        Function adding its time to a stage (e.g., to measure calls run by an executor)
+        """
+        def measured_function(*args, **kwargs):
+            with self.measure(stage):
+                return function(*args, **kwargs)
+        return measured_function
+
+    def merge(self, other: "StageStats") -> None:
+        """
+        Add times and counters of other
+        """
+        for stage, (wall, cpu) in list(other.stages.items()):
+            self.add(stage, wall, cpu)
+        for counter, value in list(other.counters.items()):
+            self.count(counter, value)
+
+    def to_document(self) -> Dict[str, Any]:
+        """
+        Compact document for MongoDB: {<stage>: {"wall": seconds, "cpu": seconds}, <counter>: value}
+        """
+        with self.lock:
+            document = {stage: {"wall": round(wall, 3), "cpu": round(cpu, 3)} for stage, (wall, cpu) in self.stages.items()}
+            document.update(self.counters)
+        return document
+
+
+class MeasuredThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool adding the time of submitted calls to a stage of stats
+    """
+
+    def __init__(self, stats: StageStats, stage: str, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+        self.stage = stage
+
+    def submit(self, fn, /, *args, **kwargs):  # pylint: disable=arguments-differ
+        return super().submit(self.stats.wrap(self.stage, fn), *args, **kwargs)
+
+
+class SlowestProfiler:
+    """
+    Profile tasks with cProfile (and tracemalloc if trace_memory) and keep the profiles of the slowest tasks only
+    Only the thread running the task is profiled by cProfile
+    Files: <output_dir>/<task>-<pid>-<duration>s.prof (pstats) and .tracemalloc.txt (top allocations)
+    """
+
+    def __init__(self, slowest: int, output_dir: str, trace_memory: bool = False) -> None:
+        self.slowest = slowest
+        self.output_dir = output_dir
+        self.trace_memory = trace_memory
+        self.profiles: List[Tuple[float, str]] = []  # Heap of (duration, file prefix) of kept profiles
+
+    @contextmanager
+    def profile(self, task: str):
+        """
+        Profile a block of code
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - start_time
+            snapshot = None
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            self.keep(task, duration, profiler, snapshot)
+
+    def keep(self, task: str, duration: float, profiler: cProfile.Profile, snapshot) -> None:
+        """
+        Dump profile if task is one of the slowest tasks so far, and remove the profile it replaces
+        """
+        if len(self.profiles) >= self.slowest and duration <= self.profiles[0][0]:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{re.sub(r'[^0-9a-zA-Z]+', '_', task)}-{os.getpid()}-{int(duration)}s")
+        profiler.dump_stats(f"{prefix}.prof")
+        if snapshot is not None:
+            with open(f"{prefix}.tracemalloc.txt", "wt", encoding="utf-8") as fd:
+                for statistic in snapshot.statistics("lineno")[:50]:
+                    fd.write(f"{statistic}\n")
+        LOGGER.info("Profile of %s (%0.1fs) written to %s.prof", task, duration, prefix)
+
+        heapq.heappush(self.profiles, (duration, prefix))
+        if len(self.profiles) > self.slowest:
+            _, removed_prefix = heapq.heappop(self.profiles)
+            for extension in [".prof", ".tracemalloc.txt"]:
+                if os.path.isfile(removed_prefix + extension):
+                    os.remove(removed_prefix + extension)
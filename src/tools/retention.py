@@ -0,0 +1,148 @@
+"""
+Retention policy of runs, shared by the fetcher (runs not retained are not inserted) and the worker (runs not retained
+are deleted)
+"""
+
+import os
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    A run is retained if it is one of the runs_per_workflow most recent runs of its workflow,
+    or one of the conclusion_quotas[conclusion] most recent runs of its workflow with the same conclusion
+    (e.g., {"failure": 2} also retains the 2 most recent failures of workflows that mostly succeed)
+    """
+
+    runs_per_workflow: int = 5
+    conclusion_quotas: Dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        """
+        Policy from RETENTION_RUNS_PER_WORKFLOW and RETENTION_CONCLUSION_QUOTAS (e.g., "failure:2,timed_out:1")
+        """
+        conclusion_quotas = {}
+        for quota in os.environ.get("RETENTION_CONCLUSION_QUOTAS", "").split(","):
+            if quota.strip():
+                conclusion, count = quota.split(":")
+                conclusion_quotas[conclusion.strip()] = int(count)
+        return cls(
+            runs_per_workflow=int(os.environ.get("RETENTION_RUNS_PER_WORKFLOW", "5")),
+            conclusion_quotas=conclusion_quotas,
+        )
+
+    def select(self, runs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Split runs returned by Github API (path, created_at and conclusion are used) into retained and discarded runs
+        Order of runs is kept
+        """
+        recency = {}  # Rank of run (by id of object) among runs of its workflow, and among runs with the same conclusion
+        workflow_counts: Dict[str, int] = {}
+        conclusion_counts: Dict[Tuple[str, str], int] = {}
+        for run in sorted(runs, key=lambda run: run["created_at"], reverse=True):
+            workflow_counts[run["path"]] = workflow_counts.get(run["path"], 0) + 1
+            conclusion_key = (run["path"], run["conclusion"])
+            conclusion_counts[conclusion_key] = conclusion_counts.get(conclusion_key, 0) + 1
+            recency[id(run)] = (workflow_counts[run["path"]], conclusion_counts[conclusion_key])
+
+        retained, discarded = [], []
+        for run in runs:
+            workflow_recency, conclusion_recency = recency[id(run)]
+            if workflow_recency <= self.runs_per_workflow \
+                    or conclusion_recency <= self.conclusion_quotas.get(run["conclusion"], 0):
+                retained.append(run)
+            else:
+                discarded.append(run)
+        return retained, discarded
+
+    def mongo_stages(self) -> List[Dict[str, Any]]:
+        """
+        Aggregation stages adding the boolean field "retained" to runs stored in MongoDB
+        Runs must have workflow_path, metadata.created_at and metadata.conclusion fields
+        """
+        quota = {
+            "$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$metadata.conclusion", conclusion]}, "then": count}
+                    for conclusion, count in self.conclusion_quotas.items()
+                ],
+                "default": 0,
+            }
+        } if self.conclusion_quotas else 0
+        return [
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$workflow_path",
+                    "sortBy": {"metadata.created_at": -1},
+                    "output": {"workflow_recency": {"$documentNumber": {}}},
+                }
+            },
+            {
+                "$setWindowFields": {
+                    "partitionBy": {"workflow_path": "$workflow_path", "conclusion": "$metadata.conclusion"},
+                    "sortBy": {"metadata.created_at": -1},
+                    "output": {"conclusion_recency": {"$documentNumber": {}}},
+                }
+            },
+            {
+                "$set": {
+                    "retained": {
+                        "$or": [
+                            {"$lte": ["$workflow_recency", self.runs_per_workflow]},
+                            {"$lte": ["$conclusion_recency", quota]},
+                        ]
+                    }
+                }
+            },
+        ]
+
+
+class RetentionTracker:
+    """
+    Count runs streamed newest first (e.g., by GithubApi.iter_workflow_runs) against the quotas of a policy:
+    once every workflow has its quotas, older runs would not be retained and the stream can be stopped (see complete)
+    """
+
+    def __init__(self, policy: RetentionPolicy, workflow_paths: Callable[[], Iterable[str]], min_runs: int = 100) -> None:
+        """
+        workflow_paths: returns paths of the workflows of the repository, called once min_runs runs are added
+        (so that streams of a few runs, e.g., incremental scrapes, do not need it)
+        """
+        self.policy = policy
+        self.workflow_paths = workflow_paths
+        self.min_runs = min_runs
+        self.runs = 0
+        self.paths: Optional[Set[str]] = None  # Workflows that must have their quotas (loaded after min_runs runs)
+        self.workflow_counts: Dict[str, int] = {}
+        self.conclusion_counts: Dict[Tuple[str, str], int] = {}
+
+    def add(self, run: Dict[str, Any]) -> None:
+        """
+        Count a run (runs must be added newest first)
+        """
+        self.runs += 1
+        self.workflow_counts[run["path"]] = self.workflow_counts.get(run["path"], 0) + 1
+        conclusion_key = (run["path"], run["conclusion"])
+        self.conclusion_counts[conclusion_key] = self.conclusion_counts.get(conclusion_key, 0) + 1
+
+    def complete(self, _run: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        True if older runs would not be retained (can be used as until predicate of GithubApi.iter_workflow_runs)
+        Older runs of a workflow missing from workflow_paths and from added runs (e.g., deleted workflow) are missed,
+        and a workflow with fewer runs than its quotas keeps the stream going until from_date
+        """
+        if self.runs < self.min_runs:
+            return False
+        if self.paths is None:
+            self.paths = set(self.workflow_paths())
+        return all(
+            self.workflow_counts.get(path, 0) >= self.policy.runs_per_workflow
+            and all(
+                self.conclusion_counts.get((path, conclusion), 0) >= count
+                for conclusion, count in self.policy.conclusion_quotas.items()
+            )
+            for path in self.paths | set(self.workflow_counts)
+        )
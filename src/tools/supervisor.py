@@ -0,0 +1,107 @@
+"""
+Prefork supervisor: run a function in N child processes and restart them when they exit
+"""
+
+import logging
+import multiprocessing
+import signal
+import time
+from typing import Callable, Dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Fork N processes running target, called with the slot of the process (0 to N - 1)
+    State loaded before run() is shared copy-on-write
+    - a process that exits is restarted (at most once every restart_delay seconds)
+    - on SIGTERM/SIGINT, processes receive SIGTERM (raised as KeyboardInterrupt in target)
+      and are killed if they are still alive after shutdown_timeout seconds
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int], None],
+        processes: int,
+        shutdown_timeout: float = 60,
+        restart_delay: float = 5,
+    ) -> None:
+        self.target = target
+        self.processes = processes
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+
+        self.context = multiprocessing.get_context("fork")
+        self.children: Dict[int, multiprocessing.Process] = {}  # key is slot
+        self.started_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def run_child(self, slot: int) -> None:
+        """
+        Entrypoint of child processes
+        """
+        # Interrupt target on SIGTERM (e.g., so that in-flight messages are requeued)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            self.target(slot)
+        except KeyboardInterrupt:
+            pass
+
+    def start_process(self, slot: int) -> None:
+        """
+        Fork a new process for slot
+        """
+        process = self.context.Process(target=self.run_child, args=(slot,), name=f"worker-{slot}")
+        process.start()
+        self.children[slot] = process
+        self.started_at[slot] = time.time()
+        LOGGER.info("Process %s started (pid %d)", process.name, process.pid)
+
+    def stop(self, *_) -> None:
+        """
+        Signal handler: stop supervising and shut processes down
+        """
+        self.stopping = True
+
+    def run(self) -> None:
+        """
+        Start processes and restart them until SIGTERM/SIGINT
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for slot in range(self.processes):
+            self.start_process(slot)
+
+        while not self.stopping:
+            for slot, process in list(self.children.items()):
+                if process.is_alive():
+                    continue
+                if time.time() - self.started_at[slot] < self.restart_delay:
+                    continue  # Avoid a restart loop if process crashes at startup
+                LOGGER.warning("Process %s exited with code %s: restarting it", process.name, process.exitcode)
+                process.join()
+                self.start_process(slot)
+            time.sleep(1)
+
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """
+        Send SIGTERM to processes, kill processes still alive after shutdown_timeout
+        """
+        LOGGER.info("Stopping %d processes...", len(self.children))
+        for process in self.children.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.time() + self.shutdown_timeout
+        for process in self.children.values():
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                LOGGER.warning("Process %s still alive after %ds: killing it", process.name, self.shutdown_timeout)
+                process.kill()
+                process.join()
+        LOGGER.info("All processes stopped")
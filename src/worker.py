@@ -2,28 +2,48 @@
 Proccess repositories from RabbitMQ queue
 """
 
+import contextlib
+import functools
 import hashlib
 import io
 import json
 import logging
 import gzip
+import multiprocessing
 import zlib
 import os
 import pika
 import pathlib
 import re
-import tarfile
+import tempfile
 import time
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from itertools import groupby
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
 
 import pymongo
 from pythonjsonlogger import jsonlogger
 
 from src.api.github import GithubApi
-from src.logs.parser import parse_log
+from src.logs.archive import DICTIONARY_SIZE, LogArchiveError, open_archive, open_archive_writer
+from src.logs.parser import (
+    BASH_PARSER_MAX_WORKERS,
+    BASH_PARSER_VERSION,
+    EXTRACTOR_CACHE,
+    PARSER_VERSION,
+    PARSING_VERSIONS,
+    is_deterministic_result,
+    parse_log_file,
+    parse_log_path,
+    reset_session,
+)
+from src.tools.metrics import Counter, Gauge, Histogram, start_http_server
+from src.tools.mongo import MONGO_DURATION, BulkWriter
 from src.tools.mq import PikaWrapper
+from src.tools.profiling import MeasuredThreadPoolExecutor, SlowestProfiler, StageStats
+from src.tools.retention import RetentionPolicy
+from src.tools.supervisor import Supervisor
 
 # Setup logging
 logging.basicConfig(
@@ -46,23 +66,102 @@ logging.getLogger("pika").setLevel(logging.WARNING)
 
 # Global variables
 
-MONGO_CLIENT = pymongo.MongoClient(
-    host=os.environ.get("MONGODB_HOST", "127.0.0.1"),
-    port=int(os.environ.get("MONGODB_PORT", "27017")),
-)
-MONGO_REPOSITORIES = MONGO_CLIENT["gha-scraper"]["repositories"]
-MONGO_RUNS = MONGO_CLIENT["gha-scraper"]["runs"]
+MONGO_CLIENT: pymongo.MongoClient = None
+MONGO_REPOSITORIES = None
+MONGO_RUNS = None
+
+
+def init_mongo() -> None:
+    """
+    Open MongoDB client (a forked process must open its own client)
+    """
+    global MONGO_CLIENT, MONGO_REPOSITORIES, MONGO_RUNS  # pylint: disable=global-statement
+    MONGO_CLIENT = pymongo.MongoClient(
+        host=os.environ.get("MONGODB_HOST", "127.0.0.1"),
+        port=int(os.environ.get("MONGODB_PORT", "27017")),
+    )
+    MONGO_REPOSITORIES = MONGO_CLIENT["gha-scraper"]["repositories"]
+    MONGO_RUNS = MONGO_CLIENT["gha-scraper"]["runs"]
+
+    # bash-command-extractor results are shared by all workers
+    EXTRACTOR_CACHE.collection = MONGO_CLIENT["gha-scraper"]["bash_extractor_cache"]
+
+
+init_mongo()
+
+GITHUB_API: GithubApi = None
+
+
+def get_github_api() -> GithubApi:
+    """
+    Github API client (created on first use, so that importing this module does not check tokens)
+    """
+    global GITHUB_API  # pylint: disable=global-statement
+    if GITHUB_API is None:
+        GITHUB_API = GithubApi()
+    return GITHUB_API
 
-GITHUB_API = GithubApi()
 
 DATA_DIR = os.environ.get("DATA_DIR", "data")
 LOGS_DIR = os.path.join(DATA_DIR, "logs")
+# Format of new log archives ("tar.gz", format of the published dataset, "zlogs" or "dedup"), all formats can be read
+LOGS_ARCHIVE_FORMAT = os.environ.get("LOGS_ARCHIVE_FORMAT", "tar.gz")
+# Number of worker processes (> 1: processes are forked by a supervisor, see main)
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+# Port of the metrics endpoint (not served if not set), worker processes use the following ports
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+# Maximum number of logs downloaded at the same time (also limited by the number of available tokens)
+DOWNLOAD_MAX_WORKERS = int(os.environ.get("DOWNLOAD_MAX_WORKERS", "4"))
 
 SANITIZE_PATTERN = re.compile(r"[^0-9a-zA-Z]+")
 
 JOB_LOG_PATH = re.compile(r"^[^/]*\.txt$")  # .txt files in root folder (jobs)
 
-SHELL_COMMAND_SEPARATOR = re.compile(r".*(&&|\|\||;|\||&|[^\\]\n).*")
+# Runs kept for each workflow (same policy as the fetcher)
+RETENTION_POLICY = RetentionPolicy.from_env()
+# Fields of runs used to process them
+RUN_PROJECTION = {
+    "workflow_path": True,
+    "metadata.created_at": True,
+    "metadata.logs_url": True,
+    "metadata.repository.full_name": True,
+    "metadata.name": True,
+    "metadata.run_number": True,
+    "metadata.run_attempt": True,
+    "logs_archive": True,
+    "log_insights": True,
+    "parsing_versions": True,
+}
+
+# Job logs are copied to memory (or to disk above this size) while their fingerprint is computed
+LOG_SPOOL_MAX_SIZE = 10 * 10**6
+
+# Number of processes used to parse the jobs of a run (0: jobs are parsed one after another in the consumer thread)
+PARSE_PROCESSES = int(os.environ.get("PARSE_PROCESSES", "0"))
+# Maximum size of the logs being parsed at the same time by these processes
+PARSE_MAX_INFLIGHT_BYTES = int(os.environ.get("PARSE_MAX_INFLIGHT_BYTES", str(500 * 10**6)))
+PARSE_POOL = None
+
+# Number of slowest repositories profiled (cProfile) by each worker process (0: profiling disabled)
+PROFILE_SLOWEST_REPOS = int(os.environ.get("PROFILE_SLOWEST_REPOS", "0"))
+PROFILER = SlowestProfiler(
+    PROFILE_SLOWEST_REPOS,
+    os.environ.get("PROFILE_DIR", os.path.join(DATA_DIR, "profiles")),
+    trace_memory=os.environ.get("PROFILE_MEMORY") == "true",  # Also trace allocations (tracemalloc, slow)
+) if PROFILE_SLOWEST_REPOS else None
+
+# Metrics
+DOWNLOAD_DURATION = Histogram("gha_worker_logs_download_duration_seconds", "Duration of downloads of run logs archives")
+DOWNLOADED_BYTES = Counter("gha_worker_logs_downloaded_bytes_total", "Size of downloaded run logs archives (ZIP)")
+PARSE_DURATION = Histogram(
+    "gha_worker_job_log_parse_duration_seconds",
+    "Duration of job log parsing (including the wait in the parse pool if PARSE_PROCESSES is set)",
+)
+PARSED_BYTES = Counter("gha_worker_job_logs_parsed_bytes_total", "Size of parsed job logs (reused results excluded)")
+RUNS = Counter("gha_worker_runs_total", "Processed runs", ["result"])
+REPOSITORIES = Counter("gha_worker_repositories_total", "Processed repositories", ["result"])
+ERRORS = Counter("gha_worker_errors_total", "Errors", ["stage"])
+INFLIGHT_MESSAGES = Gauge("gha_worker_inflight_messages", "RabbitMQ messages being processed")
 
 
 def sanitize_string(text: str) -> str:
@@ -72,16 +171,37 @@ def sanitize_string(text: str) -> str:
     return f"{SANITIZE_PATTERN.sub('_', text)}_{hashlib.sha256(text.encode()).hexdigest()[:4]}"
 
 
-def get_run_log(run_metadata):
+def download_run_zip(run_metadata, stats: Optional[StageStats] = None) -> BinaryIO:
     """
-    Store log on filesystem
-    Convert from ZIP archive to tar.gz as ZIP is compressing files independently!
+    Download log archive (ZIP) of a run to a temporary file
+    stats: processing stats of the run (download time and bytes_in)
     """
+    stats = stats if stats is not None else StageStats()
     if datetime.now() - datetime.strptime(run_metadata["created_at"], "%Y-%m-%dT%H:%M:%SZ") > timedelta(days=90):
         LOGGER.warning("Run ran more than 90d ago: log was likely deleted")
         raise ValueError("More than 90d old")
 
-    zip_bytes = GITHUB_API.get_logs(run_metadata["logs_url"])
+    with DOWNLOAD_DURATION.time(), stats.measure("download"):
+        zip_file, _ = get_github_api().download_logs(run_metadata["logs_url"])
+    zip_size = zip_file.seek(0, io.SEEK_END)
+    DOWNLOADED_BYTES.inc(zip_size)
+    stats.count("bytes_in", zip_size)
+    zip_file.seek(0)
+    return zip_file
+
+
+def get_run_log(run_metadata, run_parser=None, zip_file: Optional[BinaryIO] = None, stats: Optional[StageStats] = None):
+    """
+    Store log on filesystem
+    Convert from ZIP archive to LOGS_ARCHIVE_FORMAT as ZIP is compressing files independently!
+    (zlogs members are also compressed independently, but share a dictionary taken from the first job log)
+    run_parser: RunParser to which job logs are sent while the archive is written (job logs are decompressed once)
+    zip_file: ZIP archive already downloaded (see download_run_zip)
+    stats: processing stats of the run (conversion time and bytes_out, job logs are measured by run_parser)
+    """
+    stats = stats if stats is not None else StageStats()
+    if zip_file is None:
+        zip_file = download_run_zip(run_metadata, stats)
 
     # Compute log archive path
     workflow_log_dir = os.path.join(
@@ -93,128 +213,438 @@ def get_run_log(run_metadata):
 
     logs_archive = os.path.join(
         workflow_log_dir,
-        f"{run_metadata['run_number']}-{run_metadata['run_attempt']}.tar.gz",
+        f"{run_metadata['run_number']}-{run_metadata['run_attempt']}.{LOGS_ARCHIVE_FORMAT}",
     )
 
-    # Copy logs from ZIP to tar archive
-    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zip_fd, tarfile.open(logs_archive, "w:gz") as tar_fd:
-        for zip_info in zip_fd.infolist():
-            tar_info = tarfile.TarInfo(name=zip_info.filename)
-            tar_info.size = zip_info.file_size
-            tar_info.mtime = time.mktime(tuple(zip_info.date_time) +(-1, -1, -1))
-            tar_fd.addfile(
-                tarinfo=tar_info,
-                fileobj=zip_fd.open(zip_info.filename)
-            )
+    # Copy logs from ZIP to archive
+    with zip_file, zipfile.ZipFile(zip_file) as zip_fd:
+        job_logs = [zip_info for zip_info in zip_fd.infolist() if JOB_LOG_PATH.match(zip_info.filename)]
+        dictionary = zip_fd.open(job_logs[0]).read(DICTIONARY_SIZE) if job_logs else b""
+        with open_archive_writer(logs_archive, dictionary=dictionary) as archive_fd:
+            for zip_info in zip_fd.infolist():
+                add_to_archive = functools.partial(
+                    archive_fd.add,
+                    name=zip_info.filename,
+                    size=zip_info.file_size,
+                    mtime=time.mktime(tuple(zip_info.date_time) +(-1, -1, -1)),
+                )
+                with zip_fd.open(zip_info.filename) as member_fd:
+                    if run_parser is not None and JOB_LOG_PATH.match(zip_info.filename):
+                        run_parser.add_job(zip_info.filename, zip_info.file_size, member_fd, copy_to=add_to_archive)
+                    else:
+                        with stats.measure("conversion"):
+                            add_to_archive(fileobj=member_fd)
+    stats.count("bytes_out", os.path.getsize(logs_archive))
 
     LOGGER.info("Logs saved to %s", logs_archive)
 
     return logs_archive
 
 
-def parse_run(run):
+def fingerprint_log(fd, spool_fd) -> str:
+    """
+    Copy job log to spool_fd and return its fingerprint
+    The fingerprint is a hash of the log content and of the parser and extractor versions:
+    a log with the same fingerprint has the same insights
+    """
+    fingerprint = hashlib.sha256(f"{PARSER_VERSION}\0{BASH_PARSER_VERSION}\0".encode())
+    while chunk := fd.read(2**20):
+        fingerprint.update(chunk)
+        spool_fd.write(chunk)
+    spool_fd.seek(0)
+    return fingerprint.hexdigest()
+
+
+def has_extractor_errors(parsing_results: Dict[str, any]) -> bool:
+    """
+    True if steps of a parsed job have bash-command-extractor errors depending on API availability (e.g., API down):
+    such results are not reused for other jobs, and the job is parsed again with the run
+    """
+    return not all(is_deterministic_result(step) for step in parsing_results.get("steps", []))
+
+
+def find_parsed_job(fingerprint: str):
+    """
+    Find insights of a byte-identical job log already parsed (in any run)
+    """
+    parsed_run = MONGO_RUNS.find_one(
+        {"log_insights.fingerprint": fingerprint},
+        projection={"log_insights.$": True},
+    )
+    if parsed_run:
+        return parsed_run["log_insights"][0]
+    return None
+
+
+def init_parse_process() -> None:
+    """
+    Initialize a process of the parse pool
+    Connections are inherited from the worker process on fork and must not be shared
+    """
+    reset_session()
+    EXTRACTOR_CACHE.collection = pymongo.MongoClient(
+        host=os.environ.get("MONGODB_HOST", "127.0.0.1"),
+        port=int(os.environ.get("MONGODB_PORT", "27017")),
+    )["gha-scraper"]["bash_extractor_cache"]
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Pool of PARSE_PROCESSES processes to parse job logs, shared by all runs (see start_parse_pool)
+    """
+    global PARSE_POOL  # pylint: disable=global-statement
+    if PARSE_POOL is None:
+        PARSE_POOL = ProcessPoolExecutor(
+            max_workers=PARSE_PROCESSES,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_parse_process,
+        )
+    return PARSE_POOL
+
+
+def start_parse_pool() -> None:
+    """
+    Fork processes of the parse pool (if PARSE_PROCESSES) at worker start, before threads of the worker are started
+    (a process forked while another thread holds a lock, e.g., of logging or of the metrics, can deadlock)
+    """
+    if PARSE_PROCESSES:
+        # Processes of a fork pool are all started on first submit
+        get_parse_pool().submit(int).result()
+
+
+def stop_parse_pool() -> None:
+    """
+    Shut down the parse pool, cancelling logs not parsed yet (their copies are removed, see remove_log_copy)
+    """
+    if PARSE_POOL is not None:
+        PARSE_POOL.shutdown(cancel_futures=True)
+
+
+def remove_log_copy(future: Future, path: str) -> None:
+    """
+    Remove the copy of a job log sent to the parse pool if it was not parsed (cancelled job or broken pool)
+    Parsed copies are removed by parse_log_path
+    """
+    if future.cancelled() or future.exception() is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def open_log_copy():
+    """
+    Temporary copy of a job log
+    On disk if the log is parsed by another process, else in memory (up to LOG_SPOOL_MAX_SIZE)
+    """
+    if PARSE_PROCESSES:
+        return tempfile.NamedTemporaryFile(prefix="job-", suffix=".txt", delete=False)
+    return tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_MAX_SIZE)
+
+
+def wait_parse_budget(inflight_sizes: Dict[Future, int], size: int) -> None:
+    """
+    Wait until a log of size bytes can be sent to the parse pool without exceeding PARSE_MAX_INFLIGHT_BYTES
+    A log larger than the budget is sent once no other log is being parsed
+    """
+    for future in [future for future in inflight_sizes if future.done()]:
+        del inflight_sizes[future]
+    while inflight_sizes and sum(inflight_sizes.values()) + size > PARSE_MAX_INFLIGHT_BYTES:
+        done, _ = wait(inflight_sizes, return_when=FIRST_COMPLETED)
+        for future in done:
+            del inflight_sizes[future]
+
+
+class RunParser:
+    """
+    Compute log_insights of a run, one job log at a time
+    Job logs are parsed in this thread, or by the parse pool if PARSE_PROCESSES is set
+    Time of stages is added to stats: decompression, conversion (copy_to), mongo_read (find_parsed_job),
+    parsing (CPU time excludes the wait for extractor calls, only wall time is known in the parse pool)
+    and extractor (bash-command-extractor calls, not measured in the parse pool)
+    """
+
+    def __init__(self, run, parsed_jobs: Optional[Dict[str, any]] = None, stats: Optional[StageStats] = None) -> None:
+        """
+        parsed_jobs: insights (or Future) by fingerprint, shared by runs of a repository
+        (runs are written in batch, so job logs parsed for previous runs may not be found by find_parsed_job yet)
+        stats: processing stats of the run
+        """
+        self.run = run
+        # Insights of jobs already stored for this run, by file
+        self.stored_jobs = {job["file"]: job for job in run.get("log_insights", [])}
+        self.jobs = []  # (file, fingerprint, insights or Future of insights) in archive order
+        self.total_logs_size = 0
+        # Insights (or Future) by fingerprint, for identical jobs (e.g., matrix)
+        self.parsed_jobs = parsed_jobs if parsed_jobs is not None else {}
+        self.inflight_sizes = {}  # Size of logs being parsed by the parse pool
+        self.failed_job = None  # Name of the job log that could not be parsed
+        # False if a job has bash-command-extractor errors depending on API availability (see log_insights)
+        self.complete = True
+        self.stats = stats if stats is not None else StageStats()
+        # Calls to bash-command-extractor API are shared by all jobs of the run
+        self.extractor_executor = MeasuredThreadPoolExecutor(self.stats, "extractor", max_workers=BASH_PARSER_MAX_WORKERS)
+
+    def reuse_parsed_job(self, name: str) -> bool:
+        """
+        If the job was already parsed with the current versions (see PARSING_VERSIONS), reuse results
+        """
+        parsed_job = self.stored_jobs.get(name)
+        if parsed_job is None or parsed_job.get("error") or has_extractor_errors(parsed_job):
+            return False
+
+        if any(parsed_job.get(key) != version for key, version in PARSING_VERSIONS.items()):
+            LOGGER.debug("Job %s was parsed with other versions: parsing it again", name)
+            return False
+
+        LOGGER.debug("Job %s already parsed: reusing results", name)
+        self.jobs.append((name, parsed_job.get("fingerprint"), parsed_job))
+        self.total_logs_size += parsed_job["log_size"]
+        return True
+
+    def add_job(self, name: str, size: int, fd: BinaryIO, copy_to: Optional[Callable[..., None]] = None) -> None:
+        """
+        Parse job log read from fd
+        copy_to: called with fileobj=<copy of the job log> (e.g., to add it to an archive), so fd is read once
+        """
+        if self.reuse_parsed_job(name):
+            if copy_to is not None:
+                with self.stats.measure("conversion"):
+                    copy_to(fileobj=fd)
+            return
+
+        self.total_logs_size += size
+        LOGGER.debug("Log size: %0.2f", size/10**6)
+        submitted = False
+        log_fd = open_log_copy()
+        try:
+            with log_fd:
+                with self.stats.measure("decompression"):
+                    fingerprint = fingerprint_log(fd, log_fd)
+                if copy_to is not None:
+                    with self.stats.measure("conversion"):
+                        copy_to(fileobj=log_fd)
+                    log_fd.seek(0)
+
+                # Reuse results of a byte-identical log (e.g., rerun or matrix job)
+                # (jobs still parsed by the parse pool are reused whatever their result)
+                parsing_results = self.parsed_jobs.get(fingerprint)
+                if not parsing_results:
+                    with self.stats.measure("mongo_read"):
+                        parsing_results = find_parsed_job(fingerprint)
+                if isinstance(parsing_results, dict) and has_extractor_errors(parsing_results):
+                    parsing_results = None
+                if parsing_results:
+                    LOGGER.debug("Job %s has the same content as a job already parsed: reusing results", name)
+                elif PARSE_PROCESSES:
+                    wait_parse_budget(self.inflight_sizes, size)
+                    start_time = time.time()
+                    parsing_results = get_parse_pool().submit(parse_log_path, log_fd.name, remove=True)
+                    submitted = True
+                    parsing_results.add_done_callback(functools.partial(remove_log_copy, path=log_fd.name))
+                    parsing_results.add_done_callback(lambda _: self.observe_pool_parsing(time.time() - start_time))
+                    self.inflight_sizes[parsing_results] = size
+                    PARSED_BYTES.inc(size)
+                else:
+                    start_time = time.time()
+                    try:
+                        with self.stats.measure("parsing"):
+                            parsing_results = parse_log_file(log_fd, executor=self.extractor_executor)
+                    except Exception as err:
+                        LOGGER.exception("Fail to parse log '%s'", name)
+                        ERRORS.inc(stage="parse")
+                        self.failed_job = name
+                        raise err
+                    PARSE_DURATION.observe(time.time() - start_time)
+                    PARSED_BYTES.inc(size)
+                    parsing_duration_ms = (time.time() - start_time) * 1000
+                    LOGGER.info(
+                        "Log parsed in %dms",
+                        parsing_duration_ms,
+                        extra={"duration_ms": parsing_duration_ms}
+                    )
+        finally:
+            if PARSE_PROCESSES and not submitted:  # Copy on disk is not used by the parse pool
+                os.remove(log_fd.name)
+        self.parsed_jobs[fingerprint] = parsing_results
+        self.jobs.append((name, fingerprint, parsing_results))
+
+    def observe_pool_parsing(self, duration: float) -> None:
+        """
+        Record duration of a job log parsed by the parse pool (including the wait in the pool)
+        """
+        PARSE_DURATION.observe(duration)
+        self.stats.add("parsing", duration)
+
+    def log_insights(self) -> List[Dict[str, any]]:
+        """
+        Insights of jobs in archive order (wait for jobs parsed by the parse pool)
+        """
+        log_insights = []
+        for file, fingerprint, parsing_results in self.jobs:
+            if isinstance(parsing_results, Future):
+                try:
+                    parsing_results = parsing_results.result()
+                except Exception as err:
+                    LOGGER.exception("Fail to parse log '%s'", file)
+                    ERRORS.inc(stage="parse")
+                    self.failed_job = file
+                    raise err
+            # Jobs without steps are not kept
+            if parsing_results.get("steps") or parsing_results.get("error"):
+                log_insights.append({"file": file, **parsing_results})
+                # Jobs with extractor errors depending on API availability are not stamped with versions
+                # and fingerprint: they are parsed again (and not reused for other jobs)
+                if has_extractor_errors(parsing_results):
+                    self.complete = False
+                    for key in [*PARSING_VERSIONS, "fingerprint"]:
+                        log_insights[-1].pop(key, None)
+                else:
+                    log_insights[-1].update(PARSING_VERSIONS)
+                    if fingerprint:
+                        log_insights[-1]["fingerprint"] = fingerprint
+                log_insights[-1]["file"] = file  # Results can be reused from a job with another name
+        return log_insights
+
+    def parsing_versions(self) -> Optional[Dict[str, str]]:
+        """
+        Parsing versions of the run (None if a job must be parsed again, see log_insights)
+        """
+        return PARSING_VERSIONS if self.complete else None
+
+    def close(self) -> None:
+        """
+        Release the pool used for bash-command-extractor API calls
+        """
+        self.extractor_executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def parse_run(
+    run,
+    runs_writer: BulkWriter,
+    parsed_jobs: Optional[Dict[str, any]] = None,
+    stats: Optional[StageStats] = None,
+):
     """
     Parse run (compute log_insights)
+    stats: processing stats of the run, stored with the run (processing_stats)
     """
-    log_insights = []
-    total_logs_size = 0
-    with tarfile.open(run["logs_archive"]["path"], "r:gz") as archive_fd:
+    stats = stats if stats is not None else StageStats()
+    stats.count("bytes_in", os.path.getsize(run["logs_archive"]["path"]))
+    with open_archive(run["logs_archive"]["path"]) as archive_fd, RunParser(run, parsed_jobs, stats) as run_parser:
         for member in archive_fd.getmembers():
-            if not JOB_LOG_PATH.match(member.name):
-                continue
-
-            # If the job was already parsed, reuse results
-            if run.get("log_insights", []):
-                parsed_job = next((job for job in run["log_insights"] if job["file"] == member.name), {})
-
-                force_reparse = False
-                for step in parsed_job.get("steps", []):
-                    if step ["type"] == "shell" and step.get("commands"):
-                        if len(step["commands"]) == 1 and SHELL_COMMAND_SEPARATOR.match(step.get("code", "")):
-                            LOGGER.debug("Force reparse because there is only 1 command but there are shell separators")
-                            force_reparse = True
-                            break
-
-                        commands = [command.get("command") for command in step["commands"]]
-                        if "npm" in commands:
-                            LOGGER.debug("Force reparse because there is tar command")
-                            force_reparse = True
-                            break
-
-                if parsed_job and not parsed_job.get("error") and not force_reparse:
-                    LOGGER.debug("Job %s already parsed: reusing results", member.name)
-                    log_insights.append(parsed_job)
-                    total_logs_size += parsed_job["log_size"]
-                    continue
-
-            total_logs_size += member.size
-            LOGGER.debug("Log size: %0.2f", member.size/10**6)
-            if member.size/10**6 > 100:
-                LOGGER.warning("Log too large: ignored")
-                log_insights.append(
-                    {
-                        "file": member.name,
-                        "log_size": member.size,
-                        "error": "Log too large"
-                    }
-                )
-                continue
-            try:
-                start_time = time.time()
-                parsing_results = parse_log(archive_fd.extractfile(member).read().decode("utf-8"))
-                parsing_duration_ms = (time.time() - start_time) * 1000
-                LOGGER.info(
-                    "Log parsed in %dms",
-                    parsing_duration_ms,
-                    extra={"duration_ms": parsing_duration_ms}
-                )
-            except Exception as err:
-                LOGGER.exception("Fail to parse log '%s'", member.name)
-                raise err
-            if parsing_results.get("steps"):
-                log_insights.append(
-                    {
-                        "file": member.name,
-                        **parsing_results
-                    }
-                )
-    try:
-        MONGO_RUNS.update_one(
-            {"_id": run["_id"]},
-            {"$set":
-                {
-                    "log_insights": log_insights,
-                    "total_logs_size": total_logs_size
-                }
+            if JOB_LOG_PATH.match(member.name):
+                run_parser.add_job(member.name, member.size, archive_fd.extractfile(member))
+        log_insights = run_parser.log_insights()
+        total_logs_size = run_parser.total_logs_size
+
+    runs_writer.update_one(
+        {"_id": run["_id"]},
+        {"$set":
+            {
+                "log_insights": log_insights,
+                "total_logs_size": total_logs_size,
+                "parsing_versions": run_parser.parsing_versions(),
+                "processing_stats": stats.to_document(),
             }
-        )
-    except Exception as err:
-        LOGGER.exception("Fail to update run '%s'", run["_id"])
-        raise err
-    LOGGER.info("%d jobs parsed with success", len(log_insights))   
+        }
+    )
+    LOGGER.info("%d jobs parsed with success", len(log_insights))
+    RUNS.inc(result="parsed")
+    extractor_cache_stats = EXTRACTOR_CACHE.stats()
+    LOGGER.debug("Extractor cache: %s", extractor_cache_stats, extra={"extractor_cache": extractor_cache_stats})
 
 
-def delete_run(run):
+def select_runs(repo_name: str) -> Tuple[List[str], List[str], List[str]]:
     """
-    Delete log archive and logs insights
+    Select runs to keep (see RETENTION_POLICY) in MongoDB
+    Return ids of runs to keep, ids of runs to delete and log archives of runs to delete
+    Runs are read from a cursor (a single document listing all runs could exceed the BSON size limit)
     """
-    logs_archive_path = run.get("logs_archive", {}).get("path")
-    if logs_archive_path and os.path.isfile(logs_archive_path):
-        LOGGER.info("Deleting %s", logs_archive_path)
-        os.remove(logs_archive_path)
-    MONGO_RUNS.delete_one({"_id": run["_id"]})
+    kept_ids, pruned_ids, pruned_archives = [], [], []
+    cursor = MONGO_RUNS.aggregate(
+        [
+            {"$match": {"repository_name": repo_name}},
+            {
+                "$project": {
+                    "workflow_path": True,
+                    "metadata.created_at": True,
+                    "metadata.conclusion": True,
+                    "logs_archive.path": True,
+                }
+            },
+            *RETENTION_POLICY.mongo_stages(),
+            {"$project": {"retained": True, "logs_archive.path": True}},
+        ]
+    )
+    for run in cursor:
+        if run["retained"]:
+            kept_ids.append(run["_id"])
+        else:
+            pruned_ids.append(run["_id"])
+            if run.get("logs_archive", {}).get("path"):
+                pruned_archives.append(run["logs_archive"]["path"])
+    return kept_ids, pruned_ids, pruned_archives
 
 
-def download_run_log(run):
+def delete_runs(run_ids: List[str], logs_archive_paths: List[str], runs_writer: BulkWriter, batch_size: int = 1000):
+    """
+    Delete log archives and runs (with their logs insights)
+    Runs are deleted batch_size at a time (a single query for all runs could exceed the BSON size limit)
+    """
+    for logs_archive_path in logs_archive_paths:
+        if os.path.isfile(logs_archive_path):
+            LOGGER.info("Deleting %s", logs_archive_path)
+            os.remove(logs_archive_path)
+    for i in range(0, len(run_ids), batch_size):
+        runs_writer.delete_many({"_id": {"$in": run_ids[i:i + batch_size]}})
+
+
+def download_run_log(
+    run,
+    runs_writer: BulkWriter,
+    parse: bool = False,
+    zip_download: Optional[Future] = None,
+    parsed_jobs: Optional[Dict[str, any]] = None,
+    stats: Optional[StageStats] = None,
+):
     """
     Download log archive
+    parse: also compute log_insights while the archive is written
+    (job logs are decompressed once and the run is updated with a single query)
+    zip_download: download of the ZIP archive started in the background (Future of download_run_zip)
+    stats: processing stats of the run (also given to download_run_zip), stored with the run (processing_stats)
     """
+    update = {}
+    stats = stats if stats is not None else StageStats()
+    run_parser = RunParser(run, parsed_jobs, stats) if parse else None
     try:
-        run["logs_archive"] = {"path": get_run_log(run["metadata"])}
+        zip_file = zip_download.result() if zip_download is not None else None
+        run["logs_archive"] = {
+            "path": get_run_log(run["metadata"], run_parser=run_parser, zip_file=zip_file, stats=stats)
+        }
+        if run_parser is not None:
+            run["log_insights"] = update["log_insights"] = run_parser.log_insights()
+            update["total_logs_size"] = run_parser.total_logs_size
+            update["parsing_versions"] = run_parser.parsing_versions()
+            LOGGER.info("%d jobs parsed with success", len(run["log_insights"]))
+        RUNS.inc(result="downloaded")
     except Exception as exception:
+        if run_parser is not None and run_parser.failed_job:  # Parsing errors are not download errors
+            raise exception
         LOGGER.warning("Fail to download log '%s': %s", run["metadata"]["logs_url"], str(exception))
+        ERRORS.inc(stage="download")
+        RUNS.inc(result="download_error")
         run["logs_archive"] = {"error": str(exception)}
-    MONGO_RUNS.update_one({"_id": run["_id"]}, {"$set": {"logs_archive": run["logs_archive"]}})
+    finally:
+        if run_parser is not None:
+            run_parser.close()
+    update["processing_stats"] = stats.to_document()
+    runs_writer.update_one({"_id": run["_id"]}, {"$set": {"logs_archive": run["logs_archive"], **update}})
     return run
 
 
@@ -224,50 +654,97 @@ def process_repo(repo_name: str) -> bool:
     """
 
     LOGGER.info("Processing %s...", repo_name)
-
-    runs = list(
-        MONGO_RUNS.find(
-            {"repository_name": repo_name},
-            sort=[("workflow_path", 1), ("metadata.created_at", 1)],
+    start_time = time.perf_counter()
+    # Sum of processing stats of runs, with MongoDB queries of the repository
+    repo_stats = StageStats()
+
+    # Runs are selected in MongoDB, only runs to keep are loaded
+    with MONGO_DURATION.time(operation="select_runs"), repo_stats.measure("mongo_read"):
+        kept_ids, pruned_ids, pruned_archives = select_runs(repo_name)
+    with MONGO_DURATION.time(operation="find_runs"), repo_stats.measure("mongo_read"):
+        runs_to_process = list(
+            MONGO_RUNS.find(
+                {"_id": {"$in": kept_ids}},
+                projection=RUN_PROJECTION,
+                sort=[("workflow_path", 1), ("metadata.created_at", 1)],
+            )
         )
-    )
-    runs_by_workflows = {k: list(v) for k, v in groupby(runs, key=lambda run: run["workflow_path"])}
-
-    ### We want the 5 most recent runs for each workflow
-    nb_runs = 0
-    for workflow_path, workflow_runs in runs_by_workflows.items():
-
-        runs_to_process = workflow_runs[-5:]  # 5 most recents runs
-        nb_runs += len(runs_to_process)
-
-        runs_to_delete = workflow_runs[:-5]
-        for run in runs_to_delete:
-            delete_run(run)
-        LOGGER.info("%d runs deleted", len(runs_to_delete), extra={"repo_name": repo_name, "workflow_path": workflow_path})
-
-        LOGGER.info("%d runs to process", len(runs_to_process), extra={"repo_name": repo_name, "workflow_path": workflow_path})
-        for run in runs_to_process:
-            if (not run.get("logs_archive", {}).get("path") and not run.get("logs_archive", {}).get("error")) \
-                 or (run.get("logs_archive", {}).get("path") and not os.path.isfile(run.get("logs_archive", {}).get("path"))) \
-                 and GITHUB_API.token_available():  # Ignore if no token available
-                run = download_run_log(run)
-
-            if run.get("logs_archive", {}).get("path"):  # Download can fail, thus we check again for logs_archive.path
-                try:
-                    parse_run(run)
-                except (gzip.BadGzipFile, zlib.error):
-                    LOGGER.exception("Fail to parse run '%s'", run["_id"])
-                    LOGGER.warning("Deleting %s because it is corrupted", run["logs_archive"]["path"])
-                    os.remove(run["logs_archive"]["path"])  # If file is corrupted, delete it
-                    MONGO_RUNS.update_one({"_id": run["_id"]}, {"$unset": {"logs_archive": ""}})
+    nb_workflows = len({run["workflow_path"] for run in runs_to_process})
+
+    def should_download(run) -> bool:
+        return (not run.get("logs_archive", {}).get("path") and not run.get("logs_archive", {}).get("error")) \
+                or (run.get("logs_archive", {}).get("path") and not os.path.isfile(run.get("logs_archive", {}).get("path"))) \
+                and get_github_api().token_available()  # Ignore if no token available
+
+    # Updates and deletions of runs are sent in batch
+    runs_writer = BulkWriter(MONGO_RUNS)
+    # Insights of job logs parsed for this repository, as they are written in batch (see RunParser)
+    parsed_jobs = {}
+
+    with runs_writer:
+        ### We want the most recent runs of each workflow (see RETENTION_POLICY)
+        delete_runs(pruned_ids, pruned_archives, runs_writer)
+        LOGGER.info("%d runs deleted", len(pruned_ids), extra={"repo_name": repo_name})
+        LOGGER.info("%d runs to process", len(runs_to_process), extra={"repo_name": repo_name})
+
+        # Logs are downloaded in the background (up to 2 downloads per thread ahead of processing) while earlier runs are parsed
+        download_workers = max(1, min(DOWNLOAD_MAX_WORKERS, get_github_api().available_tokens()))
+        downloads = {}  # Future of download_run_zip by run _id
+        runs_stats = {}  # Processing stats by run _id (started with the download)
+        runs_to_download = iter(runs_to_process)
+        with ThreadPoolExecutor(max_workers=download_workers) as download_executor:
+            for run in runs_to_process:
+                while len(downloads) < 2 * download_workers:
+                    run_to_download = next(runs_to_download, None)
+                    if run_to_download is None:
+                        break
+                    if should_download(run_to_download):
+                        run_stats = runs_stats[run_to_download["_id"]] = StageStats()
+                        downloads[run_to_download["_id"]] = download_executor.submit(
+                            download_run_zip, run_to_download["metadata"], run_stats
+                        )
+
+                run_stats = runs_stats.pop(run["_id"], None) or StageStats()
+                if run["_id"] in downloads:
+                    # Job logs are parsed during download
+                    run = download_run_log(
+                        run,
+                        runs_writer,
+                        parse=True,
+                        zip_download=downloads.pop(run["_id"]),
+                        parsed_jobs=parsed_jobs,
+                        stats=run_stats,
+                    )
+
+                elif run.get("logs_archive", {}).get("path") and run.get("parsing_versions") != PARSING_VERSIONS:
+                    # Runs parsed with the current versions are not parsed again
+                    try:
+                        parse_run(run, runs_writer, parsed_jobs, run_stats)
+                    except (gzip.BadGzipFile, zlib.error, LogArchiveError):
+                        LOGGER.exception("Fail to parse run '%s'", run["_id"])
+                        RUNS.inc(result="corrupted")
+                        LOGGER.warning("Deleting %s because it is corrupted", run["logs_archive"]["path"])
+                        os.remove(run["logs_archive"]["path"])  # If file is corrupted, delete it
+                        runs_writer.update_one({"_id": run["_id"]}, {"$unset": {"logs_archive": ""}})
+                repo_stats.merge(run_stats)
+
+    repo_stats.add("mongo_write", runs_writer.write_time)
+    processing_stats = {**repo_stats.to_document(), "total": round(time.perf_counter() - start_time, 3)}
+    LOGGER.info("Processing stats: %s", processing_stats, extra={"repo_name": repo_name, "processing_stats": processing_stats})
+
+    if runs_writer.counters["errors"]:
+        LOGGER.error("Fail to write %d runs", runs_writer.counters["errors"], extra={"repo_name": repo_name})
+        ERRORS.inc(runs_writer.counters["errors"], stage="mongo_write")
+        return False
 
     MONGO_REPOSITORIES.update_one(
         {"_id": repo_name},
         {
             "$set": {
                 "processed": True,
-                "nb_workflows": len(runs_by_workflows),
-                "nb_runs": nb_runs
+                "nb_workflows": nb_workflows,
+                "nb_runs": len(runs_to_process),
+                "processing_stats": processing_stats,
             }
         }
     )
@@ -283,12 +760,19 @@ def on_message(channel, method_frame, _, body):
     mq_message = json.loads(body.decode())
     LOGGER.info("Received RabbitMQ message: %s", mq_message, extra={"repo_name": mq_message["repo_name"]})
 
+    INFLIGHT_MESSAGES.inc()
     try:
-        success = process_repo(mq_message["repo_name"])
+        # Profiles of the slowest repositories are kept (see PROFILE_SLOWEST_REPOS)
+        with PROFILER.profile(mq_message["repo_name"]) if PROFILER is not None else contextlib.nullcontext():
+            success = process_repo(mq_message["repo_name"])
         LOGGER.info("Repo processed with success", extra={"repo_name": mq_message["repo_name"]})
     except Exception:
         LOGGER.exception("Fail to process repo", extra={"repo_name": mq_message["repo_name"]})
+        ERRORS.inc(stage="repository")
         success = False
+    finally:
+        INFLIGHT_MESSAGES.dec()
+    REPOSITORIES.inc(result="success" if success else "failure")
 
     # On failure, requeue at the end of the queue
     if not success:
@@ -329,12 +813,52 @@ def worker() -> None:
                 break
         except Exception:
             LOGGER.exception("RabbitMQ failure")
+    stop_parse_pool()
+
+
+def worker_process(slot: int) -> None:
+    """
+    Entrypoint of worker processes forked by the supervisor
+    """
+    # Before threads of connections and metrics are started
+    start_parse_pool()
+
+    # Connections opened before fork must not be shared
+    init_mongo()
+    reset_session()
+    get_github_api().reset_session()
+
+    if METRICS_PORT is not None:
+        start_http_server(METRICS_PORT + slot)
+
+    worker()
 
 
 def main():
     """
     Entrypoint function
     """
+    # Index to find parsed jobs by fingerprint (see find_parsed_job)
+    MONGO_RUNS.create_index("log_insights.fingerprint", sparse=True)
+    # Index to select the most recent runs of each workflow (see select_runs)
+    MONGO_RUNS.create_index(
+        [("repository_name", pymongo.ASCENDING), ("workflow_path", pymongo.ASCENDING), ("metadata.created_at", pymongo.DESCENDING)]
+    )
+    # Index to load the most recent bash-command-extractor results (see ExtractorCache.warm)
+    EXTRACTOR_CACHE.collection.create_index([("created_at", pymongo.DESCENDING)])
+
+    if WORKER_PROCESSES > 1:
+        # Tokens are checked and the extractor cache is loaded once, then shared by forked processes
+        get_github_api().share_rate_limits()
+        LOGGER.info("%d bash-command-extractor results loaded in cache", EXTRACTOR_CACHE.warm())
+        Supervisor(worker_process, WORKER_PROCESSES).run()
+        return
+
+    start_parse_pool()
+
+    if METRICS_PORT is not None:
+        start_http_server(METRICS_PORT)
+
     # Start worker
     worker()
 
@@ -0,0 +1,165 @@
+"""
+Tests of the retrieval of workflow runs by time windows (GithubApi.get_workflow_runs and GithubApi.iter_workflow_runs)
+with a fake API on synthetic repositories (no network, no token)
+"""
+
+import math
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import pytest
+
+from src.api.github import GithubApi
+
+PER_PAGE = 100
+END_DATE = datetime(2024, 6, 1)
+
+
+class FakeResponse:
+    """
+    Response of the fake API
+    """
+
+    def __init__(self, body: Dict, links: Dict) -> None:
+        self.body = body
+        self.links = links
+        self.status_code = 200
+        self.ok = True
+        self.headers = {}
+
+    def json(self) -> Dict:
+        return self.body
+
+
+class FakeGithubApi(GithubApi):
+    """
+    GithubApi answering GET requests on actions/runs from a list of runs, counting calls
+    Runs created in the requested time window (created parameter) are returned newest first, 100 per page with a next
+    link (up to the 1000th run), with total_count, like Github API
+    """
+
+    def __init__(self, runs: List[Dict], max_calls: int = 1000) -> None:  # pylint: disable=super-init-not-called
+        self.runs = sorted(runs, key=lambda run: run["created_at"], reverse=True)
+        self.calls = 0
+        self.max_calls = max_calls
+
+    def get(self, url, params=None, headers=None, token=None, **kwargs):
+        self.calls += 1
+        assert self.calls <= self.max_calls, "Too many API calls"
+        parsed_url = urlparse(url)
+        params = params or {key: values[0] for key, values in parse_qs(parsed_url.query).items()}
+        created = params["created"]
+        if created.startswith(">"):
+            from_date, to_date = created[1:], "9999"
+        else:
+            from_date, to_date = created.split("..")
+        from_date, to_date = from_date.replace("+00:00", "Z"), to_date.replace("+00:00", "Z")
+        matching_runs = [run for run in self.runs if from_date <= run["created_at"] <= to_date]
+
+        page = int(params.get("page", 1))
+        links = {}
+        if page * PER_PAGE < min(len(matching_runs), 1000):
+            next_params = {**params, "page": page + 1}
+            links["next"] = {"url": f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}?{urlencode(next_params)}"}
+        return FakeResponse(
+            {
+                "total_count": len(matching_runs),
+                "workflow_runs": matching_runs[(page - 1) * PER_PAGE:page * PER_PAGE],
+            },
+            links,
+        )
+
+
+def make_runs(timestamps: List[float]) -> List[Dict]:
+    """
+    Runs created at timestamps (seconds before END_DATE)
+    """
+    return [
+        {
+            "id": i,
+            "path": f".github/workflows/{'ci' if i % 3 else 'release'}.yml",
+            "run_number": i,
+            "run_attempt": 1,
+            "created_at": (END_DATE - timedelta(seconds=timestamp)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        for i, timestamp in enumerate(sorted(timestamps, reverse=True))
+    ]
+
+
+def generate_runs(profile: str) -> List[Dict]:
+    """
+    Runs of the last 90 days of a synthetic repository
+    - steady: 30 runs per day
+    - busy: 300 runs per day
+    - bursty: 5 runs per day, and bursts of 3000 runs in 1 hour
+    - gap: 2000 runs in the first 10 days, none for 70 days, then 2000 runs in the last 10 days
+    - same_second: 900 runs, then 150 runs created in the last second
+    """
+    rng = random.Random(profile)
+    span = 90 * 86400
+    if profile == "steady":
+        timestamps = [rng.uniform(0, span) for _ in range(90 * 30)]
+    elif profile == "busy":
+        timestamps = [rng.uniform(0, span) for _ in range(90 * 300)]
+    elif profile == "bursty":
+        timestamps = [rng.uniform(0, span) for _ in range(90 * 5)]
+        for burst_day in rng.sample(range(90), 3):
+            burst_start = burst_day * 86400 + rng.uniform(0, 82800)
+            timestamps.extend(burst_start + rng.uniform(0, 3600) for _ in range(3000))
+    elif profile == "gap":
+        timestamps = [rng.uniform(0, 10 * 86400) for _ in range(2000)]
+        timestamps += [rng.uniform(80 * 86400, span) for _ in range(2000)]
+    else:
+        timestamps = [rng.uniform(1, 86400) for _ in range(900)] + [0] * 150
+    return make_runs(timestamps)
+
+
+# Maximum API calls by profile (lower bound: one call per page of 100 runs)
+MAX_CALLS = {"steady": 35, "busy": 320, "bursty": 160, "gap": 60, "same_second": 25}
+
+
+@pytest.mark.parametrize("profile", list(MAX_CALLS))
+def test_get_workflow_runs(profile):
+    """
+    All runs are returned once, in few calls
+    """
+    runs = generate_runs(profile)
+    api = FakeGithubApi(runs)
+    returned_runs = api.get_workflow_runs(
+        "owner/repo", from_date=END_DATE - timedelta(days=90), to_date=END_DATE, group_by_workflow=False
+    )
+    assert sorted(run["id"] for run in returned_runs) == sorted(run["id"] for run in runs)
+    assert math.ceil(len(runs) / PER_PAGE) <= api.calls <= MAX_CALLS[profile]
+
+
+@pytest.mark.parametrize("profile", list(MAX_CALLS))
+def test_iter_workflow_runs(profile):
+    """
+    Runs are streamed newest first, once, in few calls
+    """
+    runs = generate_runs(profile)
+    api = FakeGithubApi(runs)
+    streamed_runs = list(api.iter_workflow_runs("owner/repo", from_date=END_DATE - timedelta(days=90), to_date=END_DATE))
+    assert len({run["id"] for run in streamed_runs}) == len(streamed_runs)
+    assert streamed_runs == sorted(streamed_runs, key=lambda run: run["created_at"], reverse=True)
+    assert api.calls <= MAX_CALLS[profile]
+    assert sorted(run["id"] for run in streamed_runs) == sorted(run["id"] for run in runs)
+
+
+@pytest.mark.parametrize("profile", list(MAX_CALLS))
+def test_iter_workflow_runs_until(profile):
+    """
+    Streaming stops at the first known run (incremental scrape)
+    """
+    runs = generate_runs(profile)
+    api = FakeGithubApi(runs)
+    known_run_id = api.runs[49]["id"]  # 50th most recent run, in the order of the API
+    new_runs = list(
+        api.iter_workflow_runs(
+            "owner/repo", from_date=END_DATE - timedelta(days=90), until=lambda run: run["id"] == known_run_id
+        )
+    )
+    assert len(new_runs) == 49
+    assert api.calls == 1
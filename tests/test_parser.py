@@ -0,0 +1,56 @@
+"""
+Tests of log parsing (run with python -m pytest from the root of the repository)
+"""
+
+import io
+
+import pytest
+
+from src.logs import parser
+
+LOG = (
+    "2023-09-05T10:00:00.0000000Z ##[group]Run echo start\n"
+    "2023-09-05T10:00:00.0000000Z \x1b[36;1mecho " + "é" * 3000 + "\x1b[0m\n"
+    "2023-09-05T10:00:00.0000000Z \x1b[36;1mls\x1b[0m\n"
+    "2023-09-05T10:00:00.0000000Z shell: /usr/bin/bash -e {0}\n"
+    "2023-09-05T10:00:01.0000000Z ##[endgroup]\n"
+    "2023-09-05T10:00:01.0000000Z " + "x" * 5000 + " ##[group]Run not a step\n"
+    "2023-09-05T10:00:02.0000000Z ##[group]Run make\n"
+    "2023-09-05T10:00:02.0000000Z \x1b[36;1mmake\x1b[0m\n"
+    "2023-09-05T10:00:03.0000000Z ##[endgroup]\n"
+    "2023-09-05T10:00:04.0000000Z done"
+)
+
+
+@pytest.fixture(autouse=True)
+def extractor(monkeypatch):
+    """
+    Stand-in for bash-command-extractor API
+    """
+    monkeypatch.setattr(parser, "run_bash_command_extractor", lambda code, max_attempts=3: {"commands": code.split("\n")})
+
+
+@pytest.mark.parametrize("max_line_size", [16, 40, 1000])
+def test_lines_longer_than_max_line_size(monkeypatch, max_line_size):
+    """
+    Lines read in pieces are parsed like whole lines
+    """
+    expected = parser.parse_log(LOG)
+    monkeypatch.setattr(parser, "MAX_LINE_SIZE", max_line_size)
+    assert parser.parse_log_file(io.BytesIO(LOG.encode())) == expected
+
+    assert expected["total_lines"] == LOG.count("\n")
+    assert expected["log_size"] == len(LOG)
+    assert [step["code"] for step in expected["steps"]] == ["echo " + "é" * 3000 + "\nls", "make"]
+    assert expected["steps"][0]["duration_sec"] == 2
+
+
+def test_line_longer_than_max_group_body_size(monkeypatch):
+    """
+    Lines are truncated beyond MAX_GROUP_BODY_SIZE, as well as the body of the group
+    """
+    monkeypatch.setattr(parser, "MAX_LINE_SIZE", 100)
+    monkeypatch.setattr(parser, "MAX_GROUP_BODY_SIZE", 1000)
+    info = parser.parse_log_file(io.BytesIO(LOG.encode()))
+    assert info["log_size"] == len(LOG)
+    assert [step["code"] for step in info["steps"]] == ["", "make"]
@@ -0,0 +1,54 @@
+"""
+Tests of the retention policy of runs, and of the retention tracker stopping the stream of runs of the fetcher
+"""
+
+from datetime import timedelta
+
+from src.tools.retention import RetentionPolicy, RetentionTracker
+from tests.test_github_windows import END_DATE, FakeGithubApi, make_runs
+
+
+def stream_runs(api: FakeGithubApi, policy: RetentionPolicy, workflow_paths):
+    """
+    Runs streamed like the fetcher does, until older runs would not be retained
+    """
+    tracker = RetentionTracker(policy, lambda: workflow_paths)
+    runs = []
+    for run in api.iter_workflow_runs("owner/repo", from_date=END_DATE - timedelta(days=90), until=tracker.complete):
+        runs.append(run)
+        tracker.add(run)
+    return runs
+
+
+def test_stream_stops_once_retained_runs_are_found():
+    """
+    Busy repository: the stream stops after the first pages, with the same retained runs as the whole stream
+    """
+    runs = make_runs([i * 60 for i in range(20000)])
+    for run in runs:
+        run["conclusion"] = "failure" if run["id"] % 50 == 0 else "success"
+    policy = RetentionPolicy(runs_per_workflow=5, conclusion_quotas={"failure": 2})
+    api = FakeGithubApi(runs)
+
+    streamed_runs = stream_runs(api, policy, [".github/workflows/ci.yml", ".github/workflows/release.yml"])
+    assert api.calls <= 3  # 200 pages in the whole stream
+    retained_runs, _ = policy.select(streamed_runs)
+    expected_runs, _ = policy.select(runs)
+    assert sorted(run["id"] for run in retained_runs) == sorted(run["id"] for run in expected_runs)
+
+
+def test_stream_continues_for_rare_workflows():
+    """
+    A workflow with fewer runs than its quota keeps the stream going until from_date
+    """
+    runs = make_runs([i * 600 for i in range(3000)])
+    for run in runs:
+        run["conclusion"] = "success"
+    runs[-1]["path"] = ".github/workflows/nightly.yml"  # Oldest run
+    policy = RetentionPolicy(runs_per_workflow=5)
+    api = FakeGithubApi(runs)
+
+    streamed_runs = stream_runs(
+        api, policy, [".github/workflows/ci.yml", ".github/workflows/release.yml", ".github/workflows/nightly.yml"]
+    )
+    assert len(streamed_runs) == len(runs)